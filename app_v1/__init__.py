@@ -7,33 +7,47 @@ db = SQLAlchemy()
 
 def create_app(config_name):
     """Create an application instance."""
+    from .startup import StartupTimer, prewarm
+    timer = StartupTimer()
     app = Flask(__name__)
 
-    from .models import FilterReply, Module
-    from flask import request
+    with timer.step('models'):
+        from .models import FilterReply, Module
+        from flask import request
 
     # apply configuration
-    cfg = os.path.join(os.getcwd(), 'config', config_name + '.py')
-    app.config.from_pyfile(cfg)
+    with timer.step('config'):
+        cfg = os.path.join(os.getcwd(), 'config', config_name + '.py')
+        app.config.from_pyfile(cfg)
+        if not app.config.get('SECRET_KEY'):
+            # a well-known default would let anyone forge auth tokens
+            raise RuntimeError('SECRET_KEY is not set, the %s configuration '
+                               'requires it' % config_name)
 
     # initialize extensions
-    db.init_app(app)
+    with timer.step('extensions'):
+        db.init_app(app)
+        from .storage import init_app as init_storage
+        init_storage(app)
+        from .group_commit import init_app as init_group_commit
+        init_group_commit(app)
+        from .metrics import init_app as init_metrics
+        init_metrics(app)
+        from .compression import init_app as init_compression
+        init_compression(app)
 
     # authentication token route
-    from .auth import auth
-    @app.route('/get-auth-token')
-    @auth.login_required
-    def get_auth_token():
-        return jsonify({'token': g.user.generate_auth_token()})
+    with timer.step('auth'):
+        from .auth import auth
+        @app.route('/get-auth-token')
+        @auth.login_required
+        def get_auth_token():
+            return jsonify({'token': g.user.generate_auth_token()})
 
     # register blueprints
-    from app_v1.routes import api
-    app.register_blueprint(api)
-
-    from .auth import auth_token
-    @api.before_request
-    @auth_token.login_required
-    def before_request():
-        """All routes in this blueprint require authentication."""
-        pass
-    return app
\ No newline at end of file
+    with timer.step('routes'):
+        from app_v1.routes import api
+        app.register_blueprint(api)
+    app.extensions['startup'] = timer
+    prewarm(app)
+    return app
@@ -0,0 +1,48 @@
+from sqlalchemy import func, select
+from .models import FilterReply, Module
+from .serializers import decoder
+from .syllabus import update_scores
+from .module_stats import update_stats
+from .__init__ import db
+
+
+def validate_rows(model, rows, required=()):
+    """Validates every row with the same rules as model.import_data, and
+    that the columns required are not null. Returns the column values of the
+    valid rows and a list of {'index', 'message'} errors for the rest."""
+    values, errors = [], []
+    decode = decoder(model)
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({'index': index, 'message': 'Invalid row, not an object'})
+            continue
+        try:
+            row = decode(row)
+        except (ValueError, TypeError) as e:
+            # ValidationError for missing keys, the rest from bad dates
+            errors.append({'index': index, 'message': str(e.args[0])})
+            continue
+        missing = [name for name in required if row[name] is None]
+        if missing:
+            errors.append({'index': index, 'message': 'Invalid row, null ' +
+                           ', '.join(missing)})
+            continue
+        values.append(row)
+    return values, errors
+
+
+def insert_rows(model, values):
+    """Writes all values with one executemany INSERT and returns their new ids.
+    The caller is responsible for committing the session."""
+    if not values:
+        return []
+    table = model.__table__
+    db.session.execute(table.insert(), values)
+    if model is FilterReply:
+        update_scores(values)
+    elif model is Module:
+        update_stats(values)
+    # SQLite holds the write lock until the transaction ends, so the rowids
+    # handed out by this INSERT are consecutive and end at the current max.
+    last_id = db.session.execute(select([func.max(table.c.id)])).scalar()
+    return list(range(last_id - len(values) + 1, last_id + 1))
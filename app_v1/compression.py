@@ -0,0 +1,152 @@
+'''
+Response compression negotiated from Accept-Encoding, enabled with
+COMPRESSION: brotli (if the brotli package is installed), gzip or deflate,
+for JSON, NDJSON, CSV and Arrow bodies of at least COMPRESSION_MIN_SIZE
+bytes. Streamed responses (the exports and snapshots) are compressed chunk
+by chunk as they are sent, whatever their size.
+
+The compressed bodies of responses with an ETag are kept in an LRU keyed by
+URL, ETag and coding, so a repeated request for an unchanged resource is
+answered from it by conditional() without serialising or compressing
+again. Compressed responses get a weak ETag, as their bytes differ from
+the identity encoding's.
+'''
+import time
+import zlib
+from flask import request, current_app, Response
+from .utils import TTLCache
+
+compressible = ('application/json', 'application/x-ndjson', 'text/csv',
+                'text/plain', 'application/vnd.apache.arrow.stream')
+
+
+def zlib_compressor(wbits):
+    def compressor(level):
+        compressobj = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        return (compressobj.compress,
+                lambda: compressobj.flush(zlib.Z_SYNC_FLUSH),
+                compressobj.flush)
+    return compressor
+
+
+def brotli_compressor(level):
+    import brotli
+    compressor = brotli.Compressor(quality=min(level, 11))
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def available_codings():
+    """Content codings in the order of preference when the client accepts
+    several equally."""
+    codings = []
+    try:
+        import brotli  # noqa
+        codings.append(('br', brotli_compressor))
+    except ImportError:
+        pass
+    codings.append(('gzip', zlib_compressor(16 + zlib.MAX_WBITS)))
+    codings.append(('deflate', zlib_compressor(zlib.MAX_WBITS)))
+    return codings
+
+
+def choose_coding():
+    """The best coding the client accepts, None for identity."""
+    codings = current_app.extensions['compression']['codings']
+    accept = request.accept_encodings
+    coding = accept.best_match([name for name, compressor in codings])
+    if coding is None or accept.quality(coding) <= 0:
+        return None
+    return coding
+
+
+def compress(data, coding, level):
+    compress, flush, finish = dict(
+        current_app.extensions['compression']['codings'])[coding](level)
+    return compress(data) + finish()
+
+
+def compress_stream(chunks, coding, level):
+    compress, flush, finish = dict(
+        current_app.extensions['compression']['codings'])[coding](level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        # flushed per chunk so that the client gets the rows as they come
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+def cache_key(etag, coding):
+    return request.full_path, etag, coding
+
+
+def cached_response(etag):
+    """The memoised compressed response for the request's URL, etag and
+    negotiated coding, None if there is none."""
+    state = current_app.extensions.get('compression')
+    if state is None:
+        return None
+    coding = choose_coding()
+    if coding is None:
+        return None
+    cached = state['cache'].get(cache_key(etag, coding))
+    if cached is None:
+        return None
+    body, mimetype = cached
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Encoding'] = coding
+    return response
+
+
+def set_encoding(response, coding):
+    response.headers['Content-Encoding'] = coding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        # set_etag(weak=True) of werkzeug 0.9 writes a lowercase w/
+        response.headers['ETag'] = 'W/"%s"' % etag
+
+
+def init_app(app):
+    if not app.config.get('COMPRESSION'):
+        return
+    state = app.extensions['compression'] = {
+        'codings': available_codings(),
+        'cache': TTLCache(app.config.get('COMPRESSION_CACHE_SIZE', 1024))}
+    min_size = app.config.get('COMPRESSION_MIN_SIZE', 500)
+    level = app.config.get('COMPRESSION_LEVEL', 6)
+    ttl = app.config.get('COMPRESSION_CACHE_TTL', 300)
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in compressible:
+            return response
+        response.vary.add('Accept-Encoding')
+        if 'Content-Encoding' in response.headers:
+            # from cached_response
+            set_encoding(response, response.headers['Content-Encoding'])
+            return response
+        if response.status_code != 200 or response.direct_passthrough:
+            return response
+        if not response.is_streamed and \
+                response.content_length is not None and \
+                response.content_length < min_size:
+            return response
+        coding = choose_coding()
+        if coding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, coding,
+                                                level)
+            response.headers.pop('Content-Length', None)
+        else:
+            response.set_data(compress(response.get_data(), coding, level))
+            etag, weak = response.get_etag()
+            if etag is not None:
+                state['cache'].set(cache_key(etag, coding),
+                                   (response.get_data(), response.mimetype),
+                                   time.time() + ttl)
+        set_encoding(response, coding)
+        return response
@@ -0,0 +1,141 @@
+'''
+Change feed of modules and filter replies: GET /modules/?modified_since=
+returns the rows modified at or after a time and the ids of the rows deleted
+since, in the order it happened, with a cursor to ask for what follows.
+
+A position in the feed is (date, kind, id): the ModifiedDate and id of a
+changed row (kind 0) or the DeletedDate and id of a Tombstone (kind 1).
+Both are read in that order from the (ModifiedDate, id) and (Table,
+DeletedDate, id) indexes, limit rows each, and merged, so a page costs the
+size of the page whatever the size of the table. Dates are compared as the
+strings SQLite stores, which sort like the datetimes.
+
+delete_module and delete_filter_reply leave a Tombstone, kept
+FEED_TOMBSTONE_DAYS. A position older than that is refused, the client
+reloads the collection (e.g. /modules/snapshot) and follows the feed from
+the time it started reloading. POST keeps the ModifiedDate the client sends,
+a row posted with a date already passed by a cursor is not seen by it.
+'''
+import base64
+from datetime import datetime, timedelta
+from flask import current_app, request, url_for
+from .models import Tombstone, ValidationError
+from .serializers import columns, encoder
+from .snapshot import parse_since
+from .storage import read_session
+from .__init__ import db
+
+stored_format = '%Y-%m-%d %H:%M:%S.%f'
+CHANGED, DELETED = 0, 1
+
+
+def is_feed_request():
+    return 'modified_since' in request.args or 'cursor' in request.args
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(
+        ('%s|%d|%d' % position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        date, kind, id = base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8').split('|')
+        datetime.strptime(date, stored_format)
+        return date, int(kind), int(id)
+    except (ValueError, UnicodeError):
+        raise ValidationError('Invalid cursor: ' + cursor)
+
+
+def feed_position():
+    """(date, kind, id) the feed continues after, from ?cursor= or
+    ?modified_since=."""
+    cursor = request.args.get('cursor')
+    if cursor:
+        return decode_cursor(cursor)
+    since = parse_since(request.args.get('modified_since'))
+    if since is None:
+        raise ValidationError('Invalid modified_since, a date is required')
+    # before any entry of that date
+    return since.strftime(stored_format), -1, 0
+
+
+def after(date, id, kind, position):
+    """SQL condition of the entries of kind, at date and id, that come
+    after position."""
+    since, since_kind, since_id = position
+    if kind > since_kind:
+        return date >= since
+    if kind < since_kind:
+        return date > since
+    return db.tuple_(date, id) > db.tuple_(since, since_id)
+
+
+def purge_tombstones():
+    """Deletes the tombstones older than FEED_TOMBSTONE_DAYS, in the
+    current transaction."""
+    cutoff = datetime.utcnow() - timedelta(
+        days=current_app.config.get('FEED_TOMBSTONE_DAYS', 30))
+    db.session.query(Tombstone).filter(Tombstone.DeletedDate < cutoff) \
+        .delete(synchronize_session=False)
+
+
+def add_tombstone(model, id):
+    """Records the deletion of row id of model for the change feed."""
+    db.session.add(Tombstone(Table=model.__tablename__, RowId=id,
+                             DeletedDate=datetime.utcnow()))
+    purge_tombstones()
+
+
+def change_feed(model, fields, limit):
+    """Returns (rows, deleted ids, cursor of the last entry or None, number
+    of entries) of the next limit entries of the feed of model."""
+    position = feed_position()
+    cutoff = datetime.utcnow() - timedelta(
+        days=current_app.config.get('FEED_TOMBSTONE_DAYS', 30))
+    if position[0] < cutoff.strftime(stored_format):
+        raise ValidationError(
+            'Invalid position, deletions are kept %d days, reload the '
+            'collection' % current_app.config.get('FEED_TOMBSTONE_DAYS', 30))
+    session = read_session()
+    modified = db.type_coerce(model.ModifiedDate, db.String)
+    changes = session.query(modified, *columns(model, fields)) \
+        .filter(after(modified, model.id, CHANGED, position)) \
+        .order_by(model.ModifiedDate, model.id).limit(limit).all()
+    deleted = db.type_coerce(Tombstone.DeletedDate, db.String)
+    deletions = session.query(deleted, Tombstone.id, Tombstone.RowId) \
+        .filter(Tombstone.Table == model.__tablename__) \
+        .filter(after(deleted, Tombstone.id, DELETED, position)) \
+        .order_by(Tombstone.DeletedDate, Tombstone.id).limit(limit).all()
+    entries = sorted([((row[0], CHANGED, row.id), row) for row in changes] +
+                     [((row[0], DELETED, row[1]), row[2]) for row in deletions],
+                     key=lambda entry: entry[0])[:limit]
+    # the last entry of a row wins, a row deleted and then inserted again
+    # with the same id is reported as changed only
+    last = {}
+    for at, value in entries:
+        last[value.id if at[1] == CHANGED else value] = at
+    encode = encoder(model, fields)
+    rows = [encode(value[1:]) for at, value in entries
+            if at[1] == CHANGED and last[value.id] == at]
+    deleted_ids = [value for at, value in entries
+                   if at[1] == DELETED and last[value] == at]
+    cursor = encode_cursor(entries[-1][0]) if entries else None
+    return rows, deleted_ids, cursor, len(entries)
+
+
+def feed_page(model, fields, limit, key):
+    """The JSON body of a feed page listing the rows under key. next is
+    only given on a full page, cursor always (the position to poll from)."""
+    rows, deleted, cursor, count = change_feed(model, fields, limit)
+    if cursor is None:
+        cursor = request.args.get('cursor') or encode_cursor(feed_position())
+    next_url = None
+    if count == limit:
+        args = dict((name, value) for name, value in request.args.items()
+                    if name not in ('cursor', 'modified_since'))
+        next_url = url_for(request.endpoint, cursor=cursor, _external=True,
+                           **args)
+    return {key: rows, 'deleted': deleted, 'cursor': cursor,
+            'next': next_url}
@@ -0,0 +1,150 @@
+'''
+Group commit for single-row filter reply inserts, enabled with GROUP_COMMIT.
+
+The request validates its row and hands it to a background writer, which
+collects everything arriving within GROUP_COMMIT_MAX_LATENCY seconds (or
+until GROUP_COMMIT_MAX_ROWS rows) and writes it with one executemany INSERT
+in one transaction. Each request is acknowledged with its id once the
+transaction holding its row has committed, so the commit (and fsync) cost
+is shared by the whole batch instead of being paid per request.
+
+A request that waits more than GROUP_COMMIT_TIMEOUT seconds fails, and its
+row is cancelled unless the writer has already claimed it for a
+transaction, in which case the request waits for that transaction: a row is
+either written and acknowledged with its id or not written at all.
+
+With the production storage profile the acknowledgement is only as durable
+as the commit: synchronous=NORMAL in WAL mode survives a crash of the
+process but not of the machine. storage.init_app therefore switches to
+synchronous=FULL when group commit is on, the fsync being shared by the
+batch.
+'''
+import os
+import threading
+import time
+from queue import Queue, Empty
+from flask import current_app
+from .models import FilterReply
+from .bulk import insert_rows
+from .__init__ import db
+
+
+class PendingRow(object):
+    def __init__(self, values):
+        self.values = values
+        self.done = threading.Event()
+        self.id = None
+        self.error = None
+        # set under GroupCommitWriter.lock, a row is either claimed by the
+        # writer or cancelled by its timed out request
+        self.claimed = False
+        self.cancelled = False
+
+
+class GroupCommitWriter(object):
+    def __init__(self, app, model, max_rows=500, max_latency=0.005,
+                 timeout=5.0):
+        self.app = app
+        self.model = model
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.timeout = timeout
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        # started on first use, and again in a forked worker process, which
+        # does not inherit the parent's threads
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def submit(self, values):
+        """Queues the column values of one row and blocks until they are
+        committed. Returns the new id."""
+        if self.thread is None or self.pid != os.getpid():
+            self.start()
+        pending = PendingRow(values)
+        self.queue.put(pending)
+        if not pending.done.wait(self.timeout):
+            with self.lock:
+                pending.cancelled = not pending.claimed
+            if pending.cancelled:
+                raise RuntimeError('group commit timed out')
+            # in a transaction already, its outcome is the row's
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.id
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_rows:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return self.claim(batch)
+
+    def claim(self, batch):
+        """The rows of batch whose requests have not timed out, which can
+        no longer be cancelled."""
+        with self.lock:
+            for pending in batch:
+                pending.claimed = not pending.cancelled
+        return [pending for pending in batch if pending.claimed]
+
+    def write(self, batch):
+        try:
+            ids = insert_rows(self.model, [pending.values for pending in batch])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for pending, id in zip(batch, ids):
+            pending.id = id
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            with self.app.app_context():
+                try:
+                    self.write(batch)
+                except Exception:
+                    # write the rows one by one, so only the requests whose
+                    # own row fails get the error
+                    for pending in batch:
+                        try:
+                            self.write([pending])
+                        except Exception as e:
+                            pending.error = e
+                finally:
+                    db.session.remove()
+            for pending in batch:
+                pending.done.set()
+
+
+def init_app(app):
+    if not app.config.get('GROUP_COMMIT'):
+        return
+    app.extensions['group_commit'] = GroupCommitWriter(
+        app, FilterReply,
+        max_rows=app.config.get('GROUP_COMMIT_MAX_ROWS', 500),
+        max_latency=app.config.get('GROUP_COMMIT_MAX_LATENCY', 0.005),
+        timeout=app.config.get('GROUP_COMMIT_TIMEOUT', 5.0))
+
+
+def group_commit_writer():
+    """The app's writer, None if group commit is off."""
+    return current_app.extensions.get('group_commit')
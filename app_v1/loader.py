@@ -0,0 +1,128 @@
+'''
+Offline bulk loading of CSV or Parquet files into the modules and
+filterReplies tables, see load.py.
+
+The file is read in chunks with pandas (imported when a load starts, not
+with the app). Every chunk is validated with the rules of the API
+(bulk.validate_rows) and written with one executemany INSERT in its own
+transaction. After each commit the number of rows done
+and the last id are saved to a checkpoint file, so that an interrupted load
+resumes after the last committed chunk instead of starting over.
+'''
+import json
+import os
+import time
+from sqlalchemy import func, inspect, select
+from .models import Module, FilterReply
+from .bulk import validate_rows, insert_rows
+from .serializers import date_fields
+from .__init__ import db
+
+models = {'modules': Module, 'filterReplies': FilterReply}
+
+
+def read_chunks(path, model, chunksize, skip=0):
+    """DataFrames of chunksize rows of a CSV or Parquet file, starting
+    after the first skip rows."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            if skip >= batch.num_rows:
+                skip -= batch.num_rows
+                continue
+            yield batch.slice(skip).to_pandas()
+            skip = 0
+    else:
+        import pandas as pd
+        # ids such as '00123' must stay strings, dates go to parse_datetime
+        strings = dict((column.key, str) for column in model.__table__.columns
+                       if isinstance(column.type, (db.String, db.DateTime)))
+        for chunk in pd.read_csv(path, chunksize=chunksize, dtype=strings,
+                                 skiprows=range(1, skip + 1)):
+            yield chunk
+
+
+def records(chunk):
+    """The rows of a chunk as dicts for validate_rows, with None for
+    missing values and the dates as strings."""
+    import pandas as pd
+    for name in date_fields:
+        if name in chunk and pd.api.types.is_datetime64_any_dtype(chunk[name]):
+            chunk[name] = chunk[name].map(
+                lambda value: value.isoformat() if pd.notnull(value) else None)
+    chunk = chunk.astype(object).where(chunk.notnull(), None)
+    return chunk.to_dict('records')
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+def read_checkpoint(checkpoint, path, model):
+    """Rows of path already loaded according to checkpoint. A chunk that
+    was being committed when the load stopped counts as loaded if its last
+    id made it into the table."""
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return 0
+    with open(checkpoint) as f:
+        state = json.load(f)
+    if state['file'] != file_key(path):
+        raise ValueError('checkpoint %s is for another file' % checkpoint)
+    pending = state.get('pending')
+    if pending is not None:
+        last_id = db.session.execute(
+            select([func.max(model.__table__.c.id)])).scalar() or 0
+        if last_id >= pending['last_id']:
+            return pending['rows']
+    return state['rows']
+
+
+def write_checkpoint(checkpoint, state):
+    if checkpoint is None:
+        return
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def drop_indexes(model):
+    """Drops the indexes of model's table that exist: resuming a load finds
+    them dropped by the interrupted run. migrations.upgrade rebuilds them."""
+    existing = set(index['name'] for index in
+                   inspect(db.engine).get_indexes(model.__tablename__))
+    for index in model.__table__.indexes:
+        if index.name in existing:
+            index.drop(db.engine)
+
+
+def load_file(model, path, chunksize=50000, checkpoint=None,
+              progress=None, errors=None):
+    """Loads path into model's table. Returns (rows read, rows inserted,
+    invalid rows). progress(rows, inserted, seconds) is called after every
+    chunk, errors(index, message) for every invalid row."""
+    done = read_checkpoint(checkpoint, path, model)
+    key = file_key(path)
+    start = time.perf_counter()
+    read = inserted = invalid = 0
+    for chunk in read_chunks(path, model, chunksize, skip=done):
+        values, failed = validate_rows(model, records(chunk))
+        ids = insert_rows(model, values)
+        state = {'file': key, 'rows': done + read}
+        if ids:
+            state['pending'] = {'rows': done + read + len(chunk),
+                                'last_id': ids[-1]}
+            write_checkpoint(checkpoint, state)
+        db.session.commit()
+        read += len(chunk)
+        inserted += len(ids)
+        invalid += len(failed)
+        write_checkpoint(checkpoint, {'file': key, 'rows': done + read})
+        if errors is not None:
+            for error in failed:
+                errors(done + read - len(chunk) + error['index'],
+                       error['message'])
+        if progress is not None:
+            progress(done + read, inserted, time.perf_counter() - start)
+    return done + read, inserted, invalid
@@ -0,0 +1,312 @@
+'''
+Per-endpoint request metrics, enabled with METRICS and served at /metrics in
+the Prometheus text format:
+
+    http_requests_total                  by endpoint, method and status
+    http_request_duration_seconds        latency histogram by endpoint
+    http_response_size_bytes             payload size histogram by endpoint
+    db_statements_per_request            SQL statements per request
+    db_duration_seconds                  time spent in SQL per request
+
+The SQL figures come from the cursor execute events of every engine, so
+the read-only pool of the storage profile is counted too. The durations and
+sizes of streamed responses include the streaming, their bytes are counted
+as they are sent. With SLOW_REQUEST_LOG set to a number of seconds, slower
+requests are logged with their statements.
+
+/metrics answers the client addresses in METRICS_ALLOW (by default the
+local host, where the scraper runs) and otherwise asks for an auth token
+like the API, the figures naming every endpoint and its traffic.
+
+With METRICS_DIR, each process saves its figures to <pid>.json in that
+directory at most every METRICS_SAVE_INTERVAL seconds and /metrics reports
+the sum over all the files, so that the pre-forked workers of
+app_v1/server.py are counted together and a recycled worker's counts are
+not lost (retire_metrics folds them into retired.json).
+'''
+import json
+import os
+import time
+import threading
+from bisect import bisect_left
+from flask import g, request, has_app_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    """Bucket counts, sum and count of observed values. Not locked, Metrics
+    holds its lock around all updates of a request."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield name + '_bucket', labels + (('le', str(bound)),), total
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class RequestStats(object):
+    def __init__(self, statements=None):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = statements
+        self.status = None
+        self.size = None
+
+
+class Metrics(object):
+    histograms = (
+        ('http_request_duration_seconds', 'Request latency in seconds.',
+         LATENCY_BUCKETS),
+        ('http_response_size_bytes', 'Response payload size in bytes.',
+         SIZE_BUCKETS),
+        ('db_statements_per_request', 'SQL statements executed per request.',
+         COUNT_BUCKETS),
+        ('db_duration_seconds', 'Time spent executing SQL per request.',
+         LATENCY_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.series = dict((name, {}) for name, help, buckets in
+                           self.histograms)
+
+    def histogram(self, name, labels):
+        series = self.series[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            buckets = [b for n, h, b in self.histograms if n == name][0]
+            histogram = series[labels] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name, labels, value):
+        self.histogram(name, labels).observe(value)
+
+    def state(self):
+        """The figures as JSON-serialisable lists, see merge()."""
+        with self.lock:
+            return {'requests': [[labels, count] for labels, count in
+                                 self.requests.items()],
+                    'series': dict(
+                        (name, [[labels, h.counts, h.sum, h.count]
+                                for labels, h in series.items()])
+                        for name, series in self.series.items())}
+
+    def merge(self, state):
+        """Adds the figures of another process's state()."""
+        with self.lock:
+            for labels, count in state['requests']:
+                key = tuple(tuple(label) for label in labels)
+                self.requests[key] = self.requests.get(key, 0) + count
+            for name, series in state['series'].items():
+                for labels, counts, sum, count in series:
+                    histogram = self.histogram(
+                        name, tuple(tuple(label) for label in labels))
+                    histogram.counts = [a + b for a, b in
+                                        zip(histogram.counts, counts)]
+                    histogram.sum += sum
+                    histogram.count += count
+
+    def record(self, endpoint, method, stats, duration):
+        labels = (('endpoint', endpoint), ('method', method))
+        with self.lock:
+            key = labels + (('status', str(stats.status)),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.observe('http_request_duration_seconds', labels, duration)
+            if stats.size is not None:
+                self.observe('http_response_size_bytes', labels, stats.size)
+            self.observe('db_statements_per_request', labels, stats.sql_count)
+            self.observe('db_duration_seconds', labels, stats.sql_time)
+
+    def render(self):
+        lines = ['# HELP http_requests_total Requests handled.',
+                 '# TYPE http_requests_total counter']
+        with self.lock:
+            for labels, count in sorted(self.requests.items()):
+                lines.append(sample('http_requests_total', labels, count))
+            for name, help, buckets in self.histograms:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for labels, histogram in sorted(self.series[name].items()):
+                    lines.extend(sample(*s) for s in
+                                 histogram.samples(name, labels))
+        return '\n'.join(lines) + '\n'
+
+
+def sample(name, labels, value):
+    return '%s{%s} %s' % (name, ','.join(
+        '%s="%s"' % (key, label.replace('\\', '\\\\').replace('"', '\\"'))
+        for key, label in labels), repr(value))
+
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        # gone, or being replaced
+        return None
+
+
+def write_state(path, state):
+    tmp = '%s.%d.tmp' % (path, threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def save_metrics(app):
+    """Saves the figures of this process to METRICS_DIR."""
+    metrics = app.extensions.get('metrics')
+    directory = app.config.get('METRICS_DIR')
+    if metrics is None or not directory:
+        return
+    write_state(os.path.join(directory, '%d.json' % os.getpid()),
+                metrics.state())
+    metrics.saved = time.time()
+
+
+def retire_metrics(app, pid):
+    """Folds the figures of the exited process pid into retired.json."""
+    directory = app.config.get('METRICS_DIR')
+    if not app.config.get('METRICS') or not directory:
+        return
+    path = os.path.join(directory, '%d.json' % pid)
+    state = read_state(path)
+    if state is None:
+        return
+    retired = Metrics()
+    for part in (read_state(os.path.join(directory, 'retired.json')), state):
+        if part is not None:
+            retired.merge(part)
+    write_state(os.path.join(directory, 'retired.json'), retired.state())
+    os.remove(path)
+
+
+def collect_metrics(app):
+    """The figures of all the processes sharing METRICS_DIR."""
+    save_metrics(app)
+    directory = app.config['METRICS_DIR']
+    total = Metrics()
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            state = read_state(os.path.join(directory, name))
+            if state is not None:
+                total.merge(state)
+    return total
+
+
+def counted(chunks, stats):
+    """Passes the bytes chunks of a streamed response through, adding
+    their size to stats."""
+    stats.size = 0
+    for chunk in chunks:
+        stats.size += len(chunk)
+        yield chunk
+
+
+def current_stats():
+    if has_app_context():
+        return getattr(g, 'request_metrics', None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    stats = current_stats()
+    if stats is None or not conn.info.get('query_start'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats.sql_count += 1
+    stats.sql_time += elapsed
+    if stats.statements is not None:
+        stats.statements.append((elapsed, statement))
+
+
+def init_app(app):
+    if not app.config.get('METRICS'):
+        return
+    metrics = app.extensions['metrics'] = Metrics()
+    metrics.saved = time.time()
+    slow = app.config.get('SLOW_REQUEST_LOG') or None
+    interval = app.config.get('METRICS_SAVE_INTERVAL', 1.0)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = RequestStats([] if slow is not None else None)
+
+    @app.after_request
+    def size_request_metrics(response):
+        stats = getattr(g, 'request_metrics', None)
+        if stats is not None:
+            stats.status = response.status_code
+            if response.is_streamed:
+                response.response = counted(response.iter_encoded(), stats)
+            else:
+                stats.size = response.content_length
+        return response
+
+    # after a streamed response has been sent, not when it is returned
+    @app.teardown_request
+    def record_request_metrics(exc):
+        stats = getattr(g, 'request_metrics', None)
+        if stats is None:
+            return
+        g.request_metrics = None
+        if stats.status is None:
+            stats.status = 500
+        duration = time.perf_counter() - stats.start
+        metrics.record(request.endpoint or 'none', request.method, stats,
+                       duration)
+        if app.config.get('METRICS_DIR') and \
+                time.time() - metrics.saved >= interval:
+            save_metrics(app)
+        if slow is not None and duration >= slow:
+            app.logger.warning(
+                'slow request %s %s %.1f ms, %d statements in %.1f ms\n%s',
+                request.method, request.full_path, duration * 1000,
+                stats.sql_count, stats.sql_time * 1000,
+                '\n'.join('  %.1f ms  %s' % (elapsed * 1000, statement)
+                          for elapsed, statement in stats.statements))
+
+    from .auth import auth_token
+
+    def render():
+        if app.config.get('METRICS_DIR'):
+            text = collect_metrics(app).render()
+        else:
+            text = metrics.render()
+        return Response(text, mimetype='text/plain; version=0.0.4')
+    authenticated_render = auth_token.login_required(render)
+
+    @app.route('/metrics')
+    def metrics_view():
+        if request.remote_addr in (app.config.get('METRICS_ALLOW') or ()):
+            return render()
+        return authenticated_render()
@@ -0,0 +1,71 @@
+'''
+Brings an existing database (e.g. data.sqlite) up to the schema declared in
+models.py in place, without a dump/reload: missing tables are created and
+missing indexes are built with CREATE INDEX on the live tables and the
+indexes they replace are dropped. Derived
+tables (aggregates) are filled from the raw data when they are created.
+Before a unique index is built the rows that would violate it are merged.
+
+    python -m app_v1.migrations [config name]
+'''
+import os
+import sys
+from sqlalchemy import inspect
+from .syllabus import rebuild_scores
+from .module_stats import rebuild_stats
+from .upsert import merge_duplicates
+from .__init__ import db
+
+# functions filling a derived table from the existing rows when it is created
+backfills = {'syllabusScores': rebuild_scores, 'moduleStats': rebuild_stats}
+
+# functions removing the rows that violate a unique index before it is built
+deduplicate = {'uq_modules_course_material_user': merge_duplicates}
+
+# indexes superseded by others in models.py
+obsolete_indexes = {'modules': ['ix_modules_ModifiedDate',
+                                'ix_modules_course_material_user'],
+                    'filterReplies': ['ix_filterReplies_ModifiedDate']}
+
+
+def upgrade(engine=None):
+    """Creates the missing tables and indexes. Returns the names of the
+    indexes that were built."""
+    engine = engine or db.engine
+    built = []
+    created = [table for table in db.metadata.sorted_tables
+               if not engine.has_table(table.name)]
+    for table in created:
+        table.create(engine)
+    # only once all tables exist, a derived table is not ordered after the
+    # tables it is computed from (there is no foreign key between them)
+    for table in created:
+        if table.name in backfills:
+            with engine.begin() as connection:
+                backfills[table.name](connection)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in
+                       inspect(engine).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.name in deduplicate:
+                    with engine.begin() as connection:
+                        deduplicate[index.name](connection)
+                index.create(engine)
+                built.append(index.name)
+        for name in obsolete_indexes.get(table.name, ()):
+            if name in existing:
+                engine.execute('DROP INDEX "%s"' % name)
+    if built:
+        # refresh the planner statistics so the new indexes get used
+        engine.execute('ANALYZE')
+    return built
+
+
+if __name__ == '__main__':
+    from . import create_app
+    app = create_app(sys.argv[1] if len(sys.argv) > 1 else
+                     os.environ.get('FLASK_CONFIG', 'development'))
+    with app.app_context():
+        for name in upgrade():
+            print('created index ' + name)
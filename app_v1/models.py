@@ -1,18 +1,39 @@
 import os
+import time
 from flask import Flask, url_for, jsonify, request, g, current_app
 from flask.ext.sqlalchemy import SQLAlchemy
 from datetime import datetime
-from dateutil.tz import tzutc
-from dateutil import parser as datetime_parser
 from werkzeug.security import generate_password_hash, check_password_hash
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from .utils import split_url
+from sqlalchemy import event
+from .utils import split_url, TTLCache, parse_datetime, parse_number
 from .__init__ import db
 
 class ValidationError(ValueError):
     pass
 
 
+# text columns holding numbers, see app_v1.syllabus.number
+number_fields = ('Answer', 'MaxAnswer')
+
+
+def check_number(name, value):
+    """Raises ValidationError unless value is None or a number."""
+    if value is not None:
+        try:
+            parse_number(value)
+        except ValueError:
+            raise ValidationError('Invalid row, %s is not a number' % name)
+
+
+def check_datetime(name, value):
+    """value parsed by parse_datetime, ValidationError if it is not a
+    date."""
+    try:
+        return parse_datetime(value)
+    except (ValueError, OverflowError):
+        raise ValidationError('Invalid row, bad %s' % name)
+
+
 class User(db.Model):
     '''
     CREATE TABLE users(
@@ -32,21 +53,100 @@ class User(db.Model):
         return check_password_hash(self.password_hash, password)
 
     def generate_auth_token(self, expires_in=3600):
+        from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expires_in)
         return s.dumps({'id': self.id}).decode('utf-8')
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return None
-        return User.query.get(data['id'])
+        """Verified tokens are cached together with a detached copy of their
+        user, so repeated requests with the same token skip both the
+        signature check and the users query. Entries live TOKEN_CACHE_TTL
+        seconds at most and never past the expiry of the token itself, and
+        are dropped as soon as any process changes a user (check_user_version).
+        """
+        cache = token_cache()
+        check_user_version(cache)
+        user = cache.get(token)
+        if user is None:
+            try:
+                data, header = token_serializer().loads(token,
+                                                        return_header=True)
+            except:
+                return None
+            user = User.query.get(data['id'])
+            if user is None:
+                return None
+            db.session.expunge(user)
+            ttl = current_app.config.get('TOKEN_CACHE_TTL', 300)
+            cache.set(token, user, min(time.time() + ttl, header['exp']))
+        # attach a copy to this request's session without querying
+        return db.session.merge(user, load=False)
+
+
+def token_serializer():
+    """One verifying serializer per app instead of one per request."""
+    serializer = current_app.extensions.get('auth_token_serializer')
+    if serializer is None:
+        from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+        serializer = Serializer(current_app.config['SECRET_KEY'])
+        current_app.extensions['auth_token_serializer'] = serializer
+    return serializer
+
+
+def token_cache():
+    cache = current_app.extensions.get('auth_token_cache')
+    if cache is None:
+        cache = TTLCache(current_app.config.get('TOKEN_CACHE_SIZE', 1024))
+        current_app.extensions['auth_token_cache'] = cache
+    return cache
+
+
+class UserVersion(db.Model):
+    """Single row counting the changes of users, in the database so that
+    the token caches of all the worker processes see it."""
+    __tablename__ = 'userVersion'
+    id = db.Column(db.Integer, primary_key=True)
+    Version = db.Column(db.Integer, nullable=False, default=0)
+
+
+bump_user_version = db.text(
+    'INSERT INTO userVersion (id, Version) VALUES (1, 1) '
+    'ON CONFLICT (id) DO UPDATE SET Version = Version + 1')
+select_user_version = db.text('SELECT Version FROM userVersion WHERE id = 1')
+
+
+def check_user_version(cache):
+    """Empties cache if a user was changed, by this or another process,
+    since the last check. One primary key read per request, far cheaper
+    than the signature check and the users query it saves."""
+    version = db.session.execute(select_user_version).scalar() or 0
+    if version != current_app.extensions.get('auth_user_version'):
+        cache.clear()
+        current_app.extensions['auth_user_version'] = version
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_tokens(mapper, connection, target):
+    # committed with the change of the user, seen by the other workers
+    # from their next request on
+    connection.execute(bump_user_version)
+    if current_app:
+        token_cache().discard(lambda user: user.id == target.id)
+
 
 class Module(db.Model):
     __tablename__ = 'modules'
-    __table_args__ = { 'sqlite_autoincrement': True }
+    __table_args__ = (
+        # one module per user and course material, get_module_id and the
+        # upsert of PUT /modules/ look modules up by it
+        db.Index('uq_modules_course_material_user',
+                 'CourseSoftwareId', 'CourseMaterialId', 'UserId',
+                 unique=True),
+        # the change feed walks modules in (ModifiedDate, id) order
+        db.Index('ix_modules_ModifiedDate_id', 'ModifiedDate', 'id'),
+        { 'sqlite_autoincrement': True } )
     id = db.Column( db.Integer, primary_key=True )
     UserId = db.Column( db.String(255) ) 
     CourseSoftwareId = db.Column( db.String(255) )
@@ -85,10 +185,9 @@ class Module(db.Model):
             self.N2K = data['N2K']
             self.DAK = data['DAK']
             self.Included = data['Included']
-            self.CreatedDate = datetime_parser.parse(
-                data['CreatedDate'])
-            self.ModifiedDate = datetime_parser.parse(
-                data['ModifiedDate'])
+            self.CreatedDate = check_datetime('CreatedDate', data['CreatedDate'])
+            self.ModifiedDate = check_datetime('ModifiedDate',
+                                               data['ModifiedDate'])
             self.FilteredOut = data['FilteredOut']
         except KeyError as e:
             raise ValidationError('Invalid row (module), missing ' + e.args[0] )
@@ -100,6 +199,10 @@ class FilterReply(db.Model):
     # draw out conclusions & snapshots 
     # live demo of Flask API?
     __tablename__ = 'filterReplies'
+    __table_args__ = (
+        # get_filter_reply_id and calc-syllabus filter on both ids
+        db.Index('ix_filterReplies_course_user', 'CourseSoftwareId', 'UserId'),
+        db.Index('ix_filterReplies_ModifiedDate_id', 'ModifiedDate', 'id'), )
     id = db.Column(db.Integer, primary_key=True)
     UserId = db.Column(db.String(64), index=True)
     CourseSoftwareId = db.Column(db.String(64))
@@ -134,10 +237,65 @@ class FilterReply(db.Model):
             self.Type = data['Type']
             self.Answer = data['Answer']
             self.MaxAnswer = data['MaxAnswer']
-            self.CreatedDate = datetime_parser.parse(
-                data['CreatedDate'])
-            self.ModifiedDate = datetime_parser.parse(
-                data['ModifiedDate'])
+            self.CreatedDate = check_datetime('CreatedDate', data['CreatedDate'])
+            self.ModifiedDate = check_datetime('ModifiedDate',
+                                               data['ModifiedDate'])
         except KeyError as e:
             raise ValidationError('Invalid row (module), missing ' + e.args[0] )
+        for name in number_fields:
+            check_number(name, data[name])
         return self
+
+
+class SyllabusScore(db.Model):
+    # running sum and count of Answer / MaxAnswer per course, user and Type,
+    # kept up to date by app_v1.syllabus.update_scores on every reply write
+    __tablename__ = 'syllabusScores'
+    CourseSoftwareId = db.Column(db.String(64), primary_key=True)
+    UserId = db.Column(db.String(64), primary_key=True)
+    Type = db.Column(db.String(64), primary_key=True)
+    ScoreSum = db.Column(db.Float, default=0)
+    ScoreCount = db.Column(db.Integer, default=0)
+
+
+class Tombstone(db.Model):
+    # a deleted module or filter reply, for the change feed (app_v1.feed)
+    __tablename__ = 'tombstones'
+    __table_args__ = (
+        db.Index('ix_tombstones_Table_DeletedDate_id',
+                 'Table', 'DeletedDate', 'id'),
+        db.Index('ix_tombstones_DeletedDate', 'DeletedDate'), )
+    id = db.Column(db.Integer, primary_key=True)
+    Table = db.Column(db.String(64))
+    RowId = db.Column(db.Integer)
+    DeletedDate = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ModuleStat(db.Model):
+    # count, sum, sum of squares, min and max of the numeric values of each
+    # measured Module column per course and material, kept up to date by
+    # app_v1.module_stats on every module write
+    __tablename__ = 'moduleStats'
+    CourseSoftwareId = db.Column(db.String(255), primary_key=True)
+    CourseMaterialId = db.Column(db.String(255), primary_key=True)
+    Rows = db.Column(db.Integer, default=0)
+    N2KCount = db.Column(db.Integer, default=0)
+    N2KSum = db.Column(db.Float, default=0)
+    N2KSumSquares = db.Column(db.Float, default=0)
+    N2KMin = db.Column(db.Float)
+    N2KMax = db.Column(db.Float)
+    DAKCount = db.Column(db.Integer, default=0)
+    DAKSum = db.Column(db.Float, default=0)
+    DAKSumSquares = db.Column(db.Float, default=0)
+    DAKMin = db.Column(db.Float)
+    DAKMax = db.Column(db.Float)
+    IncludedCount = db.Column(db.Integer, default=0)
+    IncludedSum = db.Column(db.Float, default=0)
+    IncludedSumSquares = db.Column(db.Float, default=0)
+    IncludedMin = db.Column(db.Float)
+    IncludedMax = db.Column(db.Float)
+    FilteredOutCount = db.Column(db.Integer, default=0)
+    FilteredOutSum = db.Column(db.Float, default=0)
+    FilteredOutSumSquares = db.Column(db.Float, default=0)
+    FilteredOutMin = db.Column(db.Float)
+    FilteredOutMax = db.Column(db.Float)
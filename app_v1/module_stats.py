@@ -0,0 +1,234 @@
+'''
+Statistics of the modules of a course, per CourseMaterialId and for the
+whole course: count, mean, standard deviation, min and max of N2K and DAK,
+and the Included and FilteredOut rates.
+
+They are served from the ModuleStat summary rows, which hold the count,
+sum, sum of squares, min and max of every measured column per course and
+material. update_stats adjusts the sums on every module write. Min and max
+cannot be taken back by arithmetic, so after rows are removed or changed
+refresh_extremes recomputes them for the affected materials only, from the
+modules of that material (uq_modules_course_material_user). NULLs, and
+text written to the table around the API, are not counted.
+
+    python -m app_v1.module_stats [config name]
+
+recomputes the summary rows from scratch and reports how many had drifted.
+'''
+import math
+import os
+import sys
+from .models import Module, ModuleStat
+from .storage import read_session
+from .__init__ import db
+
+key_fields = ('CourseSoftwareId', 'CourseMaterialId')
+stat_fields = ('N2K', 'DAK', 'Included', 'FilteredOut')
+# the columns of a module that its statistics depend on
+module_stat_fields = key_fields + stat_fields
+parts = ('Count', 'Sum', 'SumSquares', 'Min', 'Max')
+
+
+def number(value):
+    """value as SQLite stores it in a REAL or INTEGER column if that is a
+    number, else None."""
+    if isinstance(value, str):
+        if '_' in value:
+            # 1_000 is a float to python only
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    elif not isinstance(value, (int, float)):
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def update_stats(rows, sign=1):
+    """Adds (sign=1) or removes (sign=-1) the module dicts rows to/from the
+    ModuleStat rows in the current transaction. After removing, call
+    refresh_extremes with the keys returned once the modules are deleted or
+    changed."""
+    deltas = {}
+    for row in rows:
+        key = (row['CourseSoftwareId'], row['CourseMaterialId'])
+        delta = deltas.get(key)
+        if delta is None:
+            delta = deltas[key] = dict(
+                zip(key_fields, key), Rows=0,
+                **dict((field + part, 0 if part in ('Count', 'Sum',
+                                                    'SumSquares') else None)
+                       for field in stat_fields for part in parts))
+        delta['Rows'] += sign
+        for field in stat_fields:
+            value = number(row.get(field))
+            if value is None:
+                continue
+            delta[field + 'Count'] += sign
+            delta[field + 'Sum'] += sign * value
+            delta[field + 'SumSquares'] += sign * value * value
+            if sign > 0:
+                low, high = delta[field + 'Min'], delta[field + 'Max']
+                delta[field + 'Min'] = value if low is None else min(low, value)
+                delta[field + 'Max'] = value if high is None else max(high, value)
+    if deltas:
+        db.session.execute(upsert_stat, list(deltas.values()))
+    return list(deltas)
+
+
+def refresh_extremes(keys):
+    """Recomputes min and max of the given (CourseSoftwareId,
+    CourseMaterialId) from their modules and deletes the emptied ones."""
+    if not keys:
+        return
+    values = [dict(zip(key_fields, key)) for key in keys]
+    db.session.execute(refresh_stat, values)
+    db.session.execute(delete_empty_stat, values)
+
+
+def numeric(column):
+    """SQL expression of column where it holds a number, NULL elsewhere,
+    the same test as number()."""
+    return db.case([(db.func.typeof(column).in_(['integer', 'real']),
+                     column)])
+
+
+def numeric_sql(field):
+    return "CASE WHEN typeof(%s) IN ('integer', 'real') THEN %s END" % (
+        field, field)
+
+
+stat_columns = ['Rows'] + [field + part for field in stat_fields
+                           for part in parts]
+
+# one executemany statement for all touched materials (SQLite >= 3.24); the
+# sums are added, min and max only ever widened here
+upsert_stat = db.text(
+    'INSERT INTO moduleStats (%s) VALUES (%s) '
+    'ON CONFLICT (CourseSoftwareId, CourseMaterialId) DO UPDATE SET %s' % (
+        ', '.join(key_fields + tuple(stat_columns)),
+        ', '.join(':' + name for name in key_fields + tuple(stat_columns)),
+        ', '.join(
+            ['%s = %s + excluded.%s' % (name, name, name)
+             for name in stat_columns
+             if not name.endswith(('Min', 'Max'))] +
+            ['%s = coalesce(%s(%s, excluded.%s), %s, excluded.%s)' % (
+                name, name[-3:].lower(), name, name, name, name)
+             for name in stat_columns if name.endswith(('Min', 'Max'))])))
+refresh_stat = db.text(
+    'UPDATE moduleStats SET (%s) = (SELECT %s FROM modules '
+    'WHERE modules.CourseSoftwareId = :CourseSoftwareId '
+    'AND modules.CourseMaterialId = :CourseMaterialId) '
+    'WHERE CourseSoftwareId = :CourseSoftwareId '
+    'AND CourseMaterialId = :CourseMaterialId' % (
+        ', '.join(field + part for field in stat_fields
+                  for part in ('Min', 'Max')),
+        ', '.join('%s(%s)' % (part.lower(), numeric_sql(field))
+                  for field in stat_fields for part in ('Min', 'Max'))))
+delete_empty_stat = db.text(
+    'DELETE FROM moduleStats WHERE CourseSoftwareId = :CourseSoftwareId '
+    'AND CourseMaterialId = :CourseMaterialId AND Rows <= 0')
+
+
+def aggregate_query():
+    """SELECT of the ModuleStat rows computed from the modules."""
+    aggregates = [db.func.count()]
+    for field in stat_fields:
+        value = numeric(getattr(Module, field))
+        aggregates += [db.func.count(value), db.func.total(value),
+                       db.func.total(value * value), db.func.min(value),
+                       db.func.max(value)]
+    return db.select([Module.CourseSoftwareId, Module.CourseMaterialId] +
+                     aggregates) \
+        .group_by(Module.CourseSoftwareId, Module.CourseMaterialId)
+
+
+def same(old, new):
+    if old is None or new is None:
+        return old is new
+    return abs(old - new) <= 1e-9 * max(1.0, abs(old), abs(new))
+
+
+def rebuild_stats(bind=None):
+    """Recomputes all ModuleStat rows from the modules. Returns the number
+    of rows that differed from the stored ones."""
+    bind = bind or db.session
+    table = ModuleStat.__table__
+    names = list(key_fields) + stat_columns
+    stored = dict(((row[0], row[1]), tuple(row[2:])) for row in bind.execute(
+        db.select([table.c[name] for name in names])))
+    fresh = dict(((row[0], row[1]), tuple(row[2:]))
+                 for row in bind.execute(aggregate_query()))
+    drifted = 0
+    for key in set(stored) | set(fresh):
+        old, new = stored.get(key), fresh.get(key)
+        if old is None or new is None or \
+                not all(same(a, b) for a, b in zip(old, new)):
+            drifted += 1
+    bind.execute(table.delete())
+    if fresh:
+        bind.execute(table.insert(), [dict(zip(names, key + value))
+                                      for key, value in fresh.items()])
+    return drifted
+
+
+def distribution(count, total, squares, low, high):
+    if not count:
+        return {'count': 0, 'mean': None, 'stddev': None, 'min': None,
+                'max': None}
+    mean = total / count
+    return {'count': count, 'mean': mean,
+            'stddev': math.sqrt(max(0.0, squares / count - mean * mean)),
+            'min': low, 'max': high}
+
+
+def summarize(stats):
+    """The statistics of the union of the ModuleStat rows stats."""
+    data = {'count': sum(stat.Rows for stat in stats)}
+    for field in stat_fields:
+        count = sum(getattr(stat, field + 'Count') for stat in stats)
+        lows = [getattr(stat, field + 'Min') for stat in stats
+                if getattr(stat, field + 'Min') is not None]
+        highs = [getattr(stat, field + 'Max') for stat in stats
+                 if getattr(stat, field + 'Max') is not None]
+        values = distribution(
+            count, sum(getattr(stat, field + 'Sum') for stat in stats),
+            sum(getattr(stat, field + 'SumSquares') for stat in stats),
+            min(lows) if lows else None, max(highs) if highs else None)
+        if field in ('Included', 'FilteredOut'):
+            data[field + 'Rate'] = values['mean']
+        else:
+            data[field] = values
+    return data
+
+
+def course_stats(CourseSoftwareId, CourseMaterialId=None):
+    """Statistics of the course's modules as a dict with one entry per
+    material under 'materials', or of one material. None if there are no
+    modules."""
+    # plain rows, the ORM costs more than the summing for a few hundred
+    query = read_session().query(*ModuleStat.__table__.columns) \
+        .filter(ModuleStat.CourseSoftwareId == CourseSoftwareId)
+    if CourseMaterialId is not None:
+        query = query.filter(ModuleStat.CourseMaterialId == CourseMaterialId)
+    stats = query.order_by(ModuleStat.CourseMaterialId).all()
+    if not stats:
+        return None
+    if CourseMaterialId is not None:
+        return summarize(stats)
+    data = summarize(stats)
+    data['materials'] = dict((stat.CourseMaterialId, summarize([stat]))
+                             for stat in stats)
+    return data
+
+
+if __name__ == '__main__':
+    from . import create_app
+    app = create_app(sys.argv[1] if len(sys.argv) > 1 else
+                     os.environ.get('FLASK_CONFIG', 'development'))
+    with app.app_context():
+        drifted = rebuild_stats()
+        db.session.commit()
+        print('rebuilt module statistics, %d rows had drifted' % drifted)
@@ -1,56 +1,397 @@
-import pandas as pd
+import json
+import hashlib
 
-from flask import jsonify, request
+from flask import jsonify, request, Response, stream_with_context
 from datetime import datetime
-from dateutil import parser as datetime_parser
-from flask import url_for, current_app, Blueprint
-from .models import User, Module, FilterReply, ValidationError
+from flask import url_for, current_app, Blueprint, abort
+from .models import User, Module, FilterReply, ValidationError, \
+    number_fields, check_number, check_datetime
+from .bulk import validate_rows, insert_rows
+from .serializers import columns, encoder, decoder
+from .syllabus import compute_pivot, update_scores, score_fields
+from .module_stats import update_stats, refresh_extremes, \
+    module_stat_fields, course_stats
+from .auth import auth_token
+from .storage import read_session
+from .group_commit import group_commit_writer
+from .compression import cached_response
+from .upsert import upsert_modules, unique_module_key, key_fields
+from .feed import is_feed_request, feed_page, add_tombstone
+from .snapshot import default_format, check_format, parse_since, \
+    stream_snapshot, mimetypes
 from .__init__ import db 
 
 
 api = Blueprint('api', __name__)
 
 
+# registered here rather than in create_app so that it is in place before
+# the blueprint is registered on the first app
+@api.before_request
+@auth_token.login_required
+def before_request():
+    """All routes in this blueprint require authentication."""
+    pass
+
+
+def get_request_rows():
+    '''
+    Returns the list of rows of a bulk request (a JSON array or an NDJSON
+    body), or None when the body is a single JSON object.
+    '''
+    if request.mimetype == 'application/x-ndjson':
+        rows = []
+        for line in request.get_data().decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)  # reported as an invalid row
+        return rows
+    if isinstance(request.json, list):
+        return request.json
+    return None
+
+
+def requested_fields(model):
+    '''
+    Column names asked for with ?fields=a,b in table order, always including
+    id. None when the parameter is absent, i.e. all columns.
+    '''
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = fields.split(',')
+    names = [column.key for column in model.__table__.columns]
+    unknown = [field for field in fields if field not in names]
+    if unknown:
+        raise ValidationError('Invalid fields, unknown ' + ', '.join(unknown))
+    return [name for name in names if name == 'id' or name in fields]
+
+
+def get_row(model, id, fields):
+    '''Column-projected SELECT of one row as a dict, 404 if missing.'''
+    row = read_session().query(*columns(model, fields)) \
+        .filter(model.id == id).first()
+    if row is None:
+        abort(404)
+    return encoder(model, fields)(row)
+
+
+def get_rows(model, ids, fields):
+    '''
+    Column-projected rows of the given ids as dicts in the order of ids,
+    fetched with one SELECT ... WHERE id IN (...), and the ids not found.
+    '''
+    rows = {}
+    if ids:
+        encode = encoder(model, fields)
+        rows = dict((row.id, encode(row)) for row in read_session().query(
+            *columns(model, fields)).filter(model.id.in_(ids)))
+    return [rows[id] for id in ids if id in rows], \
+        [id for id in ids if id not in rows]
+
+
+def multi_get_ids():
+    '''The distinct ids of ?ids=1,2,3 in the order given.'''
+    ids = []
+    for id in request.args.get('ids').split(','):
+        if not id.strip().isdigit():
+            raise ValidationError('Invalid ids, not an integer: ' + id)
+        if int(id) not in ids:
+            ids.append(int(id))
+    maximum = current_app.config.get('MAX_MULTI_GET', 1000)
+    if len(ids) > maximum:
+        raise ValidationError('Invalid ids, at most %d' % maximum)
+    return ids
+
+
+def multi_get(model, key):
+    '''Response of GET /<collection>/?ids=1,2,3[&fields=a,b].'''
+    rows, missing = get_rows(model, multi_get_ids(), requested_fields(model))
+    return jsonify({key: rows, 'missing': missing})
+
+
+def lookup_fields(model):
+    '''
+    Columns the lookup routes return inline: [] for none (ids only), None
+    for all with ?fields=all, else as requested_fields.
+    '''
+    if 'fields' not in request.args:
+        return []
+    if request.args['fields'] == 'all':
+        return None
+    return requested_fields(model)
+
+
+def lookup_results(model, results, fields, key):
+    data = {'ids': [result.id for result in results]}
+    if fields != []:
+        encode = encoder(model, fields)
+        data[key] = [encode(result) for result in results]
+    return data
+
+
+def page_args():
+    after_id = request.args.get('after_id', 0, type=int)
+    limit = request.args.get('limit', current_app.config.get('PAGE_SIZE', 100),
+                             type=int)
+    if limit < 1:
+        raise ValidationError('Invalid limit, must be a positive integer')
+    return after_id, min(limit, current_app.config.get('MAX_PAGE_SIZE', 1000))
+
+
+def get_page(query, id_column):
+    '''
+    Keyset pagination on the primary key driven by ?after_id=&limit=. Returns
+    the page and the url of the next one (None on the last page), which
+    keeps the other arguments of the request such as ?fields=.
+    '''
+    after_id, limit = page_args()
+    items = query.filter(id_column > after_id).order_by(id_column).limit(limit).all()
+    next_url = None
+    if len(items) == limit:
+        args = dict((name, value) for name, value in request.args.items()
+                    if name not in ('after_id', 'limit'))
+        next_url = url_for(request.endpoint, after_id=items[-1].id,
+                           limit=limit, _external=True, **args)
+    return items, next_url
+
+
+def conditional(etag, last_modified, build):
+    '''
+    Answers 304 when If-None-Match / If-Modified-Since match the validators,
+    otherwise returns build() (or its memoised compressed body) with ETag
+    and Last-Modified headers. Without last_modified only If-None-Match is
+    honoured and no Last-Modified is sent.
+    '''
+    # checked by hand, the ETags of werkzeug 0.9 are always true on python 3
+    # which makes make_conditional ignore If-Modified-Since. The comparison
+    # is weak, compressed responses carry W/ ETags.
+    if request.headers.get('If-None-Match'):
+        unmodified = request.if_none_match.contains_weak(etag)
+    else:
+        unmodified = request.if_modified_since is not None and \
+            last_modified is not None and \
+            last_modified.replace(microsecond=0) <= request.if_modified_since
+    if unmodified:
+        response = Response(status=304)
+    else:
+        response = cached_response(etag) or build()
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def row_validators(model, id):
+    '''
+    ETag and Last-Modified of one row from its ModifiedDate alone, so that
+    a 304 never loads the row. Aborts with 404 for unknown ids.
+    '''
+    row = read_session().query(model.ModifiedDate).filter(model.id == id).first()
+    if row is None:
+        abort(404)
+    modified = row[0]
+    etag = '%d-%s' % (id, modified.isoformat() if modified else '')
+    return etag + request.args.get('fields', ''), modified
+
+
+def page_columns(model, columns):
+    '''
+    The columns of a page query led by the raw ModifiedDate of each row,
+    which page_etag needs: the page is fetched once and a 304 is decided
+    from the rows fetched.
+    '''
+    return [db.type_coerce(model.ModifiedDate, db.String)] + list(columns)
+
+
+def page_etag(rows):
+    '''
+    ETag of a page from the ModifiedDate and id of its rows (queried with
+    page_columns). Collections are validated by ETag only, a deletion or an
+    insertion into the page changes it without moving its latest date.
+    '''
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update(('%d %s;' % (row.id, row[0])).encode('utf-8'))
+    digest.update(request.args.get('fields', '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def export_rows(model):
+    '''
+    Streams every row of model as NDJSON, one export_data() line at a time
+    (only ?fields= if given). Rows are fetched in chunks of EXPORT_CHUNK_SIZE
+    so memory stays flat.
+    '''
+    chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 1000)
+    fields = requested_fields(model)
+    query = read_session().query(*columns(model, fields)).order_by(model.id)
+    encode = encoder(model, fields)
+
+    def generate():
+        for row in query.yield_per(chunk_size):
+            yield json.dumps(encode(row)) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def snapshot(model):
+    '''
+    Streams a columnar snapshot of model (?format=parquet|arrow|csv, only
+    rows modified at or after ?since= if given), see app_v1/snapshot.py.
+    '''
+    format = request.args.get('format') or default_format()
+    check_format(format)
+    since = parse_since(request.args.get('since'))
+    chunk_size = current_app.config.get('SNAPSHOT_CHUNK_SIZE', 65536)
+    filename = '%s.%s' % (model.__tablename__, format)
+    return Response(
+        stream_with_context(stream_snapshot(model, format, since, chunk_size)),
+        mimetype=mimetypes[format],
+        headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+
+def patch_values(model, data):
+    '''
+    Column values of a PATCH body: only the supplied fields are validated,
+    CreatedDate is stored naive and ModifiedDate is always set to now. id and
+    unknown keys are ignored.
+    '''
+    if not isinstance(data, dict):
+        raise ValidationError('Invalid patch, not an object')
+    columns = model.__table__.columns
+    values = {}
+    for key, value in data.items():
+        if key in ('id', 'ModifiedDate') or key not in columns:
+            continue
+        if key == 'CreatedDate':
+            # SQLite can't store timezone aware datetimes
+            value = check_datetime(key, value).replace(tzinfo=None)
+        elif key in number_fields:
+            check_number(key, value)
+        values[key] = value
+    values['ModifiedDate'] = datetime.utcnow()
+    return values
+
+
+def patch_row(model, id, values):
+    '''Single UPDATE ... WHERE id = ? of the given columns, 404 if no row.'''
+    table = model.__table__
+    result = db.session.execute(table.update().where(table.c.id == id)
+                                .values(values))
+    if result.rowcount == 0:
+        abort(404)
+
+
+def bulk_insert(model, rows):
+    values, errors = validate_rows(model, rows)
+    with unique_module_key():
+        ids = insert_rows(model, values)
+        db.session.commit()
+    status = 201 if ids or not errors else 400
+    return jsonify({'ids': ids, 'errors': errors}), status
+
+
 @api.route('/filterReplies/', methods=['POST'])
 def new_filter_reply():
     '''
     http --auth jakub:Freeman POST http://localhost:5000/filterReplies/ UserId=aaaa CourseSoftwareId=aaaaa Type=AOI Answer=5 MaxAnswer=12 CreatedDate='22 Jan 2013' ModifiedDate='23 Jun 2013'
+
+    A JSON array or an NDJSON body inserts all rows in one transaction and
+    returns {'ids': [...], 'errors': [{'index': i, 'message': ...}]}
     '''
+    rows = get_request_rows()
+    if rows is not None:
+        return bulk_insert(FilterReply, rows)
+    writer = group_commit_writer()
+    if writer is not None:
+        id = writer.submit(decoder(FilterReply)(request.json))
+        return jsonify({}), 201, {'Location' : id }
     filter_reply = FilterReply()
     filter_reply.import_data(request.json)
     db.session.add(filter_reply)
+    update_scores([filter_reply.export_data()])
     db.session.commit()
     return jsonify({}), 201, {'Location' : filter_reply.id } 
     # this also needs to be changed? seems correct, is missing /filterReplies/
 
 @api.route('/filterReplies/', methods=['GET'])
 def get_filter_replies():
-    return jsonify( {'filterReplies' : [ reply.export_data() for reply in FilterReply.query.all()]} )
+    '''
+    http --auth jakub:Freeman GET http://localhost:5000/filterReplies/ after_id==100 limit==50 fields==UserId,N2K
+
+    With Accept: application/x-ndjson the whole table is streamed instead.
+    With ?modified_since= or ?cursor= the change feed is returned, see
+    app_v1/feed.py. ?ids=1,2,3 returns those replies in that order and the
+    ids not found under 'missing'
+    '''
+    if wants_ndjson():
+        return export_filter_replies()
+    if 'ids' in request.args:
+        return multi_get(FilterReply, 'filterReplies')
+    fields = requested_fields(FilterReply)
+    if is_feed_request():
+        return jsonify(feed_page(FilterReply, fields, page_args()[1],
+                                 'filterReplies'))
+
+    replies, next_url = get_page(read_session().query(
+        *page_columns(FilterReply, columns(FilterReply, fields))), FilterReply.id)
+    encode = encoder(FilterReply, fields)
+    return conditional(page_etag(replies), None, build=lambda: jsonify(
+        {'filterReplies' : [ encode(reply[1:]) for reply in replies ],
+         'next' : next_url}))
+
+@api.route('/filterReplies/export', methods=['GET'])
+def export_filter_replies():
+    '''
+    http --stream --auth jakub:Freeman GET http://localhost:5000/filterReplies/export
+    '''
+    return export_rows(FilterReply)
+
+@api.route('/filterReplies/snapshot', methods=['GET'])
+def snapshot_filter_replies():
+    '''
+    http --download --auth jakub:Freeman GET http://localhost:5000/filterReplies/snapshot format==parquet since==2013-06-01
+    '''
+    return snapshot(FilterReply)
 
 @api.route('/filterReplies/<int:id>', methods=['GET'])
 def get_filter_reply(id):
     '''
     http --auth jakub:Freeman GET http://localhost:5000/filterReplies/1
+
+    Honours If-None-Match / If-Modified-Since with a 304, ?fields=a,b selects
+    only those columns
     '''
-    return jsonify(FilterReply.query.get_or_404(id).export_data())
+    fields = requested_fields(FilterReply)
+    return conditional(*row_validators(FilterReply, id), build=lambda:
+        jsonify(get_row(FilterReply, id, fields)))
 
 @api.route('/filterReplies/<int:id>', methods=['PATCH'])
 def modify_filter_reply(id):
     '''
     http  --auth jakub:Freeman PATCH http://localhost:5000/filterReplies/2 UserId='Jakub Langr'
     '''
-    filter_reply = FilterReply.query.get_or_404(id)
-    filter_reply_data = filter_reply.export_data()
-    new_data = request.json 
-    for datum in new_data.keys():
-        filter_reply_data[datum] = new_data[datum]
-
-    # this ridiculousness is because of bs way that python handles datetime and the
-    # inability of SQLite to convert timezone aware to naive datetimes  
-    filter_reply_data['ModifiedDate'] = datetime.utcnow().isoformat()
-    filter_reply_data['CreatedDate'] = datetime_parser.parse(filter_reply_data['CreatedDate']).replace(tzinfo=None).isoformat()
-    filter_reply.import_data(filter_reply_data)
-    db.session.add(filter_reply)
+    values = patch_values(FilterReply, request.json)
+    if any(key in values for key in score_fields):
+        # move the reply's score from its old aggregate to the new one
+        old = db.session.query(*[getattr(FilterReply, key) for key in score_fields]) \
+            .filter(FilterReply.id == id).first()
+        if old is None:
+            abort(404)
+        old = dict(zip(score_fields, old))
+        update_scores([old], -1)
+        update_scores([dict(old, **values)])
+    patch_row(FilterReply, id, values)
     db.session.commit()
     return jsonify({})
 
@@ -58,16 +399,24 @@ def modify_filter_reply(id):
 def get_filter_reply_id(CourseSoftwareId,UserId):
     '''
     http --auth jakub:Freeman GET http://localhost:5000/filterReplies/aaaaa/aaaa
+
+    With ?fields=a,b (or ?fields=all) the replies are listed in full under
+    'filterReplies' as well
     '''
-    results = FilterReply.query.filter_by(CourseSoftwareId=CourseSoftwareId,
-        UserId=UserId)
-    results = { 'ids' : [result.id for result in results ] }
-    return jsonify( results )
+    fields = lookup_fields(FilterReply)
+    query = read_session().query(*columns(FilterReply, fields)) \
+        if fields != [] else read_session().query(FilterReply.id)
+    results = query.filter(FilterReply.CourseSoftwareId == CourseSoftwareId,
+                           FilterReply.UserId == UserId).all()
+    return jsonify(lookup_results(FilterReply, results, fields,
+                                  'filterReplies'))
 
 @api.route('/filterReplies/<int:id>', methods=['DELETE'])
 def delete_filter_reply(id):
     filter_reply = FilterReply.query.get_or_404(id)
+    update_scores([filter_reply.export_data()], -1)
     db.session.delete(filter_reply)
+    add_tombstone(FilterReply, id)
     db.session.commit()
     return jsonify({})
 
@@ -76,25 +425,84 @@ def delete_filter_reply(id):
 
 @api.route('/modules/', methods=['GET'])
 def get_modules():
-    return jsonify({'module ids' : [ module.id for module in Module.query.all() ] })
+    '''
+    http --auth jakub:Freeman GET http://localhost:5000/modules/ after_id==100 limit==50
+
+    With ?fields=a,b the page lists those columns of each module under
+    'modules'. With Accept: application/x-ndjson all modules are streamed in
+    full instead. With ?modified_since= or ?cursor= the change feed of
+    the modules is returned, see app_v1/feed.py
+
+    http --auth jakub:Freeman GET http://localhost:5000/modules/ modified_since==2013-06-01
+
+    ?ids=1,2,3 returns those modules in that order and the ids not found
+    under 'missing'
+
+    http --auth jakub:Freeman GET http://localhost:5000/modules/ ids==1,2,3
+    '''
+    if wants_ndjson():
+        return export_modules()
+    if 'ids' in request.args:
+        return multi_get(Module, 'modules')
+    fields = requested_fields(Module)
+    if is_feed_request():
+        return jsonify(feed_page(Module, fields, page_args()[1], 'modules'))
+
+    if fields is not None:
+        modules, next_url = get_page(read_session().query(
+            *page_columns(Module, columns(Module, fields))), Module.id)
+        encode = encoder(Module, fields)
+        return conditional(page_etag(modules), None, build=lambda: jsonify(
+            {'modules' : [ encode(module[1:]) for module in modules ],
+             'next' : next_url}))
+    modules, next_url = get_page(
+        read_session().query(*page_columns(Module, [Module.id])), Module.id)
+    return conditional(page_etag(modules), None, build=lambda: jsonify(
+        {'module ids' : [ module.id for module in modules ],
+         'next' : next_url}))
+
+@api.route('/modules/export', methods=['GET'])
+def export_modules():
+    '''
+    http --stream --auth jakub:Freeman GET http://localhost:5000/modules/export
+    '''
+    return export_rows(Module)
+
+@api.route('/modules/snapshot', methods=['GET'])
+def snapshot_modules():
+    '''
+    http --download --auth jakub:Freeman GET http://localhost:5000/modules/snapshot format==parquet since==2013-06-01
+    '''
+    return snapshot(Module)
 
 @api.route('/modules/<int:id>', methods=['GET'])
 def get_module(id):
     '''
     http --auth jakub:Freeman GET http://localhost:5000/modules/12
+
+    Honours If-None-Match / If-Modified-Since with a 304, ?fields=a,b selects
+    only those columns
     '''
-    return jsonify( Module.query.get_or_404(id).export_data() )
+    fields = requested_fields(Module)
+    return conditional(*row_validators(Module, id), build=lambda:
+        jsonify( get_row(Module, id, fields) ))
 
 # NOT ENTIRELY SURE IF THIS IS A NECESSARY METHOD TO HAVE?
 @api.route('/module-id/<string:CourseSoftwareId>/<string:CourseMaterialId>/<string:UserId>', methods=['GET'])
 def get_module_id(CourseMaterialId,CourseSoftwareId,UserId):
     '''
-    http --auth jakub:Freeman GET http://localhost:5000/module-id/aaaaa/bbbbb/aaac
+    http --auth jakub:Freeman GET http://localhost:5000/module-id/aaaaa/bbbbb/aaac fields==all
+
+    With ?fields=a,b (or ?fields=all) the modules are listed in full under
+    'modules' as well
     '''
-    results = Module.query.filter_by(CourseSoftwareId=CourseSoftwareId,
-        CourseMaterialId=CourseMaterialId, UserId=UserId).all()
-    results = {'ids': [ result.id for result in results ] }
-    return jsonify( results )
+    fields = lookup_fields(Module)
+    query = read_session().query(*columns(Module, fields)) \
+        if fields != [] else read_session().query(Module.id)
+    results = query.filter(Module.CourseSoftwareId == CourseSoftwareId,
+                           Module.CourseMaterialId == CourseMaterialId,
+                           Module.UserId == UserId).all()
+    return jsonify(lookup_results(Module, results, fields, 'modules'))
 
 
 @api.route('/modules/<int:id>', methods=['PATCH'])
@@ -102,18 +510,22 @@ def edit_module(id):
     '''
     http --auth jakub:Freeman PATCH http://localhost:5000/12 UserId='jaaaak'
     '''
-    module = Module.query.get_or_404(id)
-    module_data = module.export_data()
-    new_data = request.json 
-    for datum in new_data.keys():
-        module_data[datum] = new_data[datum]
-
-    # this ridiculousness is because of bs way that python handles datetime and the
-    # inability of SQLite to convert timezone aware to naive datetimes  
-    module_data['ModifiedDate'] = datetime.utcnow().isoformat()
-    module_data['CreatedDate'] = datetime_parser.parse(module_data['CreatedDate']).replace(tzinfo=None).isoformat()
-    module.import_data(module_data)
-    db.session.add(module)
+    values = patch_values(Module, request.json)
+    if any(key in values for key in module_stat_fields):
+        # move the module's values from its old statistics to the new ones
+        old = db.session.query(*[getattr(Module, key) for key in module_stat_fields]) \
+            .filter(Module.id == id).first()
+        if old is None:
+            abort(404)
+        old = dict(zip(module_stat_fields, old))
+        keys = update_stats([old], -1)
+        update_stats([dict(old, **values)])
+        with unique_module_key():
+            patch_row(Module, id, values)
+        refresh_extremes(keys)
+    else:
+        with unique_module_key():
+            patch_row(Module, id, values)
     db.session.commit()
     return jsonify({})
 
@@ -123,20 +535,81 @@ def new_module():
     http --auth jakub:Freeman POST http://localhost:5000/modules/ UserId='aaac' CourseSoftwareId='aaaaa' CourseMaterialId='bbbbb' N2K=.25 DAK=.32 Included=1 FilteredOut=0 CreatedDate='22 Jan 2013' ModifiedDate='23 Jun 2013'
 
     Location: http://localhost:5000/modules/aaac
+
+    Accepts a JSON array or an NDJSON body as well, see new_filter_reply
     '''
+    rows = get_request_rows()
+    if rows is not None:
+        return bulk_insert(Module, rows)
     module = Module()
     module.import_data(request.json)
     db.session.add(module)
-    db.session.commit()
+    update_stats([request.json])
+    with unique_module_key():
+        db.session.commit()
     return jsonify({}), 201, {'Location': '/modules/' + str(module.id)} # again, not .self_url() ? is missing /modules/
 
+@api.route('/modules/', methods=['PUT'])
+def put_module():
+    '''
+    http --auth jakub:Freeman PUT http://localhost:5000/modules/ UserId='aaac' CourseSoftwareId='aaaaa' CourseMaterialId='bbbbb' N2K=.5 DAK=.32 Included=1 FilteredOut=0 CreatedDate='22 Jan 2013' ModifiedDate='24 Jun 2013'
+
+    Records the module of its CourseSoftwareId, CourseMaterialId and UserId:
+    creates it (201) or updates the existing one in place (200), see
+    app_v1/upsert.py. A JSON array or an NDJSON body upserts all valid rows
+    in one transaction and returns {'ids': [...], 'created': n,
+    'errors': [...]}
+    '''
+    rows = get_request_rows()
+    values, errors = validate_rows(Module, [request.json] if rows is None
+                                   else rows, key_fields)
+    if rows is None:
+        if errors:
+            raise ValidationError(errors[0]['message'])
+        ids, created = upsert_modules(values)
+        db.session.commit()
+        return jsonify({}), 201 if created else 200, \
+            {'Location': '/modules/' + str(ids[0])}
+    ids, created = upsert_modules(values)
+    db.session.commit()
+    status = 200 if ids or not errors else 400
+    return jsonify({'ids': ids, 'created': created, 'errors': errors}), status
+
 @api.route('/modules/<int:id>', methods=['DELETE'])
 def delete_module(id):
     module = Module.query.get_or_404(id)
+    keys = update_stats([module.export_data()], -1)
     db.session.delete(module)
+    add_tombstone(Module, id)
+    db.session.flush()
+    refresh_extremes(keys)
     db.session.commit()
     return jsonify({})
 
+@api.route('/modules/stats/<string:CourseSoftwareId>', methods=['GET'])
+def get_module_stats(CourseSoftwareId):
+    '''
+    http --auth jakub:Freeman GET http://localhost:5000/modules/stats/aaaaa
+
+    Count, mean, stddev, min and max of N2K and DAK and the Included and
+    FilteredOut rates of the course's modules, overall and per material
+    '''
+    stats = course_stats(CourseSoftwareId)
+    if stats is None:
+        abort(404)
+    return jsonify(dict(stats, CourseSoftwareId=CourseSoftwareId))
+
+@api.route('/modules/stats/<string:CourseSoftwareId>/<string:CourseMaterialId>', methods=['GET'])
+def get_material_stats(CourseSoftwareId, CourseMaterialId):
+    '''
+    http --auth jakub:Freeman GET http://localhost:5000/modules/stats/aaaaa/bbbbb
+    '''
+    stats = course_stats(CourseSoftwareId, CourseMaterialId)
+    if stats is None:
+        abort(404)
+    return jsonify(dict(stats, CourseSoftwareId=CourseSoftwareId,
+                        CourseMaterialId=CourseMaterialId))
+
 
 
 
@@ -144,19 +617,34 @@ def delete_module(id):
 def get_set_replies(CourseSoftwareId,UserId):
     '''
     http --auth jakub:Freeman GET http://localhost:5000/calc-syllabus/aaaaa/aaac
+
+    Served from the SyllabusScore aggregates, ?engine=sql recomputes the pivot
+    from the raw replies and ?engine=pandas with the reference implementation
+    '''
+    engine = request.args.get('engine',
+                              current_app.config.get('SYLLABUS_ENGINE', 'materialized'))
+    pivot = compute_pivot(CourseSoftwareId, [UserId], engine)
+    return jsonify({'CourseSoftwareId' : CourseSoftwareId,
+                    'UserId' : UserId,
+                    'syllabus' : pivot.get(UserId, {})})
+
+@api.route('/calc-syllabus/<string:CourseSoftwareId>', methods=['GET'])
+def get_cohort_replies(CourseSoftwareId):
+    '''
+    http --auth jakub:Freeman GET http://localhost:5000/calc-syllabus/aaaaa UserIds==aaac,aaad
+
+    Pivot of every user of the course in one pass, missing Types are imputed
+    with the course-wide mean. UserIds only filters which users are returned.
     '''
-    results = FilterReply.query.filter_by(CourseSoftwareId=CourseSoftwareId,
-                                        UserId=UserId).all()
-    callback = [ result.export_data() for result in results ]
-    results = {'results': callback }
-    filter_replies = pd.DataFrame.from_dict(callback)
-    filter_replies.Answer = filter_replies.Answer / filter_replies.MaxAnswer
-
-    pt = filter_replies.pivot_table(index='UserId', columns='Type',values='Answer')
-    pt_filled = pt.fillna(pt.mean())
-    
-    print( pt_filled )
-    return jsonify( results )
+    engine = request.args.get('engine',
+                              current_app.config.get('SYLLABUS_ENGINE', 'materialized'))
+    pivot = compute_pivot(CourseSoftwareId, None, engine)
+    UserIds = request.args.get('UserIds')
+    if UserIds:
+        pivot = dict((UserId, pivot[UserId]) for UserId in UserIds.split(',')
+                     if UserId in pivot)
+    return jsonify({'CourseSoftwareId' : CourseSoftwareId,
+                    'syllabus' : pivot})
 
 
 
@@ -0,0 +1,61 @@
+'''
+Precompiled row serializers for the bulk paths. They produce the same dicts
+as Model.export_data / Model.import_data, but work on plain Core result rows
+(no ORM objects, no identity map), format the dates straight from the
+strings SQLite stores and parse ISO-8601 without dateutil.
+'''
+from .models import ValidationError, number_fields, check_number, \
+    check_datetime
+from .utils import format_datetime
+from .__init__ import db
+
+date_fields = ('CreatedDate', 'ModifiedDate')
+
+
+def table_columns(model, fields=None):
+    return [column for column in model.__table__.columns
+            if fields is None or column.key in fields]
+
+
+def columns(model, fields=None):
+    """Labelled column expressions for a Core select of model (restricted to
+    fields if given) whose rows encoder(model, fields) understands. The dates
+    are read as raw strings."""
+    return [db.type_coerce(column, db.String).label(column.key)
+            if column.key in date_fields else column
+            for column in table_columns(model, fields)]
+
+
+def encoder(model, fields=None):
+    """Returns a function turning a row selected with columns(model, fields)
+    into the dict model.export_data() would return (restricted to fields)."""
+    names = [column.key for column in table_columns(model, fields)]
+    dates = [name for name in names if name in date_fields]
+
+    def encode(row):
+        data = dict(zip(names, row))
+        for name in dates:
+            data[name] = format_datetime(data[name])
+        return data
+    return encode
+
+
+def decoder(model):
+    """Returns a function validating a dict like model.import_data() and
+    returning the column values to insert."""
+    names = [column.key for column in model.__table__.columns
+             if column.key != 'id']
+    dates = [name for name in names if name in date_fields]
+    numbers = [name for name in names if name in number_fields]
+
+    def decode(data):
+        try:
+            values = dict((name, data[name]) for name in names)
+        except KeyError as e:
+            raise ValidationError('Invalid row (module), missing ' + e.args[0])
+        for name in dates:
+            values[name] = check_datetime(name, values[name])
+        for name in numbers:
+            check_number(name, values[name])
+        return values
+    return decode
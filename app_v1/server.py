@@ -0,0 +1,266 @@
+'''
+Pre-fork production server, used by run.py when WORKERS is set.
+
+The master process creates the app and the listening socket, then forks
+WORKERS processes that accept on the shared socket, each answering
+requests on THREADS threads. A worker exits after MAX_REQUESTS requests
+(plus up to MAX_REQUESTS_JITTER, so they do not all restart together) to
+bound the memory pandas accumulates, and the master replaces it.
+
+Signals to the master:
+
+    TERM, INT   finish the requests in progress, then stop
+    HUP         re-create the app (re-reading the config), start fresh
+                workers and let the old ones finish their requests
+
+Code changes need a restart, HUP only reloads the configuration; if the
+app cannot be created the running workers are kept. A worker that crashes
+is replaced after a delay that doubles up to 30 seconds while they keep
+crashing. With METRICS the workers share their counters through files in
+METRICS_DIR (a temporary directory by default), so /metrics reports the
+totals of all of them, including the recycled ones.
+'''
+import errno
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+from .metrics import save_metrics, retire_metrics
+from .startup import wait_prewarm
+from .__init__ import db
+
+
+class WorkerServer(BaseWSGIServer):
+    """Werkzeug's server on an inherited listening socket, handling the
+    requests on a pool of threads."""
+    multiprocess = True
+
+    def __init__(self, listener, app, threads):
+        host, port = listener.getsockname()[:2]
+        self.address_family = listener.family
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.socket.close()
+        self.socket = listener
+        self.server_address = listener.getsockname()
+        self.multithread = threads > 1
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.handled = 0
+
+    def server_bind(self):
+        # the master bound the socket already
+        pass
+
+    def server_activate(self):
+        pass
+
+    def get_request(self):
+        # the socket is non-blocking so that a worker losing the race for a
+        # connection to another one gets an error instead of blocking
+        connection, address = self.socket.accept()
+        connection.setblocking(True)
+        return connection, address
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        if self.executor is None:
+            return BaseWSGIServer.process_request(self, request,
+                                                  client_address)
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+def parse_address(address):
+    """(host, port) of 'host:port', the host of an IPv6 address in
+    brackets as in '[::1]:5000'."""
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('Invalid address, must be host:port: ' + address)
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    return host, int(port)
+
+
+def listen(address, backlog=128):
+    host, port = parse_address(address)
+    listener = socket.socket(socket.AF_INET6 if ':' in host
+                             else socket.AF_INET)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    listener.setblocking(False)
+    return listener
+
+
+def reset_connections(app):
+    """Drops the database connections inherited from the master."""
+    with app.app_context():
+        db.get_engine(app).dispose()
+        read_session = app.extensions.get('read_session')
+        if read_session is not None:
+            read_session.remove()
+            read_session.bind.dispose()
+
+
+def run_worker(app, listener):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(1))
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    reset_connections(app)
+
+    max_requests = app.config.get('MAX_REQUESTS', 0)
+    if max_requests:
+        max_requests += random.randint(0, app.config.get('MAX_REQUESTS_JITTER',
+                                                         0))
+    server = WorkerServer(listener, app, app.config.get('THREADS', 1))
+    server.timeout = 0.5
+    while not stopping and not (max_requests and
+                                server.handled >= max_requests):
+        try:
+            server.handle_request()
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    server.close()
+    save_metrics(app)
+
+
+class Master(object):
+    max_backoff = 30.0
+
+    def __init__(self, app, factory=None):
+        self.app = app
+        self.factory = factory
+        self.workers = {}
+        self.stopping = False
+        self.reloading = False
+        self.backoff = 0.0
+        self.next_spawn = 0.0
+        self.metrics_dir = None
+
+    def prepare(self, app):
+        # the workers inherit the prewarmed modules
+        wait_prewarm(app)
+        if app.config.get('METRICS') and not app.config.get('METRICS_DIR'):
+            if self.metrics_dir is None:
+                self.metrics_dir = tempfile.mkdtemp(prefix='metrics-')
+            app.config['METRICS_DIR'] = self.metrics_dir
+        return app
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.listener)
+            except Exception:
+                self.app.logger.exception('worker failed')
+                status = 1
+            finally:
+                os._exit(status)
+        self.workers[pid] = self.app
+
+    def stop_workers(self, app=None):
+        for pid, worker_app in list(self.workers.items()):
+            if app is None or worker_app is app:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            app = self.workers.pop(pid, None)
+            if app is not None:
+                retire_metrics(app, pid)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                self.backoff = 0.0
+            elif not self.stopping:
+                # crashed, wait before replacing it so that a worker failing
+                # at startup does not make the master fork in a tight loop
+                self.backoff = min(self.max_backoff,
+                                   max(0.1, self.backoff * 2))
+                self.next_spawn = time.time() + self.backoff
+                self.app.logger.error('worker %d exited with status %d, '
+                                      'replacing it in %.1f s', pid, status,
+                                      self.backoff)
+
+    def reload(self):
+        old = self.app
+        try:
+            self.app = self.prepare(self.factory())
+        except Exception:
+            self.app.logger.exception('reload failed, keeping the running '
+                                      'workers')
+            return
+        for i in range(self.app.config.get('WORKERS', 1)):
+            self.spawn()
+        self.stop_workers(old)
+
+    def run(self):
+        self.prepare(self.app)
+        self.listener = listen(self.app.config.get('LISTEN',
+                                                   '127.0.0.1:5000'))
+        signal.signal(signal.SIGTERM, lambda *args: self.stop())
+        signal.signal(signal.SIGINT, lambda *args: self.stop())
+        signal.signal(signal.SIGHUP, lambda *args: setattr(
+            self, 'reloading', self.factory is not None))
+        sys.stderr.write('listening on %s:%d with %d workers\n' % (
+            self.listener.getsockname()[:2] +
+            (self.app.config.get('WORKERS', 1),)))
+        while True:
+            self.reap()
+            if self.stopping:
+                if not self.workers:
+                    break
+            elif self.reloading:
+                self.reloading = False
+                self.reload()
+            else:
+                current = [pid for pid, app in self.workers.items()
+                           if app is self.app]
+                # replace the workers that exited (recycled or crashed)
+                if time.time() >= self.next_spawn:
+                    for i in range(self.app.config.get('WORKERS', 1) -
+                                   len(current)):
+                        self.spawn()
+            time.sleep(0.1)
+        self.listener.close()
+        if self.metrics_dir is not None:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def stop(self):
+        self.stopping = True
+        self.stop_workers()
+
+
+def serve(app, factory=None):
+    """Runs app on WORKERS pre-forked processes until TERM or INT.
+    factory() creates the app again on HUP."""
+    Master(app, factory).run()
@@ -0,0 +1,205 @@
+'''
+Columnar snapshots of the modules and filterReplies tables for analysis.
+
+The rows are read straight from the cursor in chunks of SNAPSHOT_CHUNK_SIZE
+and every chunk becomes one Parquet row group or Arrow record batch, so
+memory stays flat whatever the table size. The columns keep their types
+(int64, float64, string, timestamp[us]). Without pyarrow only CSV is
+available. With since, only rows modified at or after it are exported,
+for incremental snapshots.
+
+    python -m app_v1.snapshot modules modules.parquet [--since 2013-06-01]
+'''
+import argparse
+import csv
+import io
+import os
+from datetime import timezone
+from .models import Module, FilterReply, ValidationError
+from .serializers import columns, table_columns, date_fields
+from .storage import read_session
+from .utils import parse_datetime, format_datetime
+from .__init__ import db
+
+mimetypes = {'parquet': 'application/vnd.apache.parquet',
+             'arrow': 'application/vnd.apache.arrow.stream',
+             'csv': 'text/csv'}
+
+
+def pyarrow_available():
+    try:
+        import pyarrow  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def default_format():
+    return 'parquet' if pyarrow_available() else 'csv'
+
+
+def check_format(format):
+    if format not in mimetypes:
+        raise ValidationError('Invalid format, must be one of ' +
+                              ', '.join(sorted(mimetypes)))
+    if format != 'csv' and not pyarrow_available():
+        raise ValidationError('Invalid format, %s needs pyarrow, use csv'
+                              % format)
+
+
+def parse_since(value):
+    """Lower bound on ModifiedDate as the naive UTC datetime it is stored
+    as, None if not given."""
+    if not value:
+        return None
+    try:
+        since = parse_datetime(value)
+    except (ValueError, OverflowError):
+        raise ValidationError('Invalid since, not a date: ' + value)
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return since
+
+
+def arrow_schema(model):
+    import pyarrow as pa
+    types = {db.Integer: pa.int64(), db.Float: pa.float64(),
+             db.DateTime: pa.timestamp('us')}
+    return pa.schema([
+        (column.key, next((t for cls, t in types.items()
+                           if isinstance(column.type, cls)), pa.string()))
+        for column in table_columns(model)])
+
+
+def chunks(model, since=None, chunk_size=1000):
+    """Lists of up to chunk_size rows of model, dates as stored strings."""
+    query = db.select(columns(model)).order_by(model.id)
+    if since is not None:
+        query = query.where(model.ModifiedDate >= since)
+    # the DBAPI cursor, SQLAlchemy's row processing is not needed for these
+    # column types and costs as much as the fetch itself
+    cursor = read_session().execute(query).cursor
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def arrow_batch(schema, rows):
+    import pyarrow as pa
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if pa.types.is_timestamp(field.type):
+            # SQLite's '2013-01-22 10:00:00.000000' casts without Python
+            arrays.append(pa.array(values, pa.string()).cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def snapshot_parts(model, sink, format, since=None, chunk_size=1000):
+    """Writes the snapshot to the binary file object sink, yielding the
+    number of rows written so far after every chunk and once more when the
+    file is complete."""
+    count = 0
+    if format == 'csv':
+        text = io.TextIOWrapper(sink, encoding='utf-8', newline='',
+                                write_through=True)
+        writer = csv.writer(text)
+        names = [column.key for column in table_columns(model)]
+        writer.writerow(names)
+        dates = [i for i, name in enumerate(names) if name in date_fields]
+        for rows in chunks(model, since, chunk_size):
+            for row in rows:
+                row = list(row)
+                for i in dates:
+                    row[i] = format_datetime(row[i])
+                writer.writerow(row)
+            count += len(rows)
+            yield count
+        text.detach()
+        yield count
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = arrow_schema(model)
+    if format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema)
+        write = lambda batch: writer.write_table(
+            pa.Table.from_batches([batch]))
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+    for rows in chunks(model, since, chunk_size):
+        write(arrow_batch(schema, rows))
+        count += len(rows)
+        yield count
+    writer.close()
+    yield count
+
+
+def write_snapshot(model, path, format, since=None, chunk_size=1000):
+    """Writes the snapshot to path. Returns the number of rows."""
+    count = 0
+    with open(path, 'wb') as sink:
+        for count in snapshot_parts(model, sink, format, since, chunk_size):
+            pass
+    return count
+
+
+class StreamSink(io.RawIOBase):
+    """Write-only file object whose contents are taken out with drain()."""
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def stream_snapshot(model, format, since=None, chunk_size=1000):
+    """Generator of the bytes of the snapshot, handed out chunk by chunk."""
+    sink = StreamSink()
+    for count in snapshot_parts(model, sink, format, since, chunk_size):
+        data = sink.drain()
+        if data:
+            yield data
+
+
+models = {'modules': Module, 'filterReplies': FilterReply}
+
+
+if __name__ == '__main__':
+    from . import create_app
+    parser = argparse.ArgumentParser(description='Write a columnar snapshot '
+                                     'of a table.')
+    parser.add_argument('table', choices=sorted(models))
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=sorted(mimetypes),
+                        help='default: from the file extension')
+    parser.add_argument('--since', help='only rows modified at or after this')
+    parser.add_argument('--config',
+                        default=os.environ.get('FLASK_CONFIG', 'development'))
+    args = parser.parse_args()
+    format = args.format or os.path.splitext(args.path)[1][1:]
+    app = create_app(args.config)
+    with app.app_context():
+        check_format(format)
+        count = write_snapshot(models[args.table], args.path, format,
+                               parse_since(args.since),
+                               app.config.get('SNAPSHOT_CHUNK_SIZE', 65536))
+        print('wrote %d rows to %s' % (count, args.path))
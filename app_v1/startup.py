@@ -0,0 +1,129 @@
+'''
+Cold start of the app: what create_app spends its time on, and the
+background import of the modules only some requests need.
+
+pandas costs more to import than the rest of the app together and only the
+pandas engine of calc-syllabus and the bulk loader use it, so it is
+imported where it is used; dateutil only for dates that are not ISO-8601.
+PREWARM_IMPORTS lists modules to import in a background thread as soon as
+the app is created, so that the first request needing them does not wait.
+The pre-fork server waits for that thread before forking, so the workers
+share the modules instead of importing them each.
+
+    python -m app_v1.startup [config name] [--json]
+
+creates the app in this fresh interpreter and reports the time of each step
+of create_app, the modules it imported and the peak memory of the process.
+STARTUP_TIME_BUDGET and STARTUP_MEMORY_BUDGET are the limits the tests hold
+it to.
+'''
+import argparse
+import importlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer(object):
+    """Durations of the named steps of create_app, in order."""
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - start))
+
+
+def prewarm(app):
+    """Imports PREWARM_IMPORTS in a background thread."""
+    modules = app.config.get('PREWARM_IMPORTS') or ()
+    if not modules:
+        return None
+
+    def run():
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                app.logger.warning('cannot prewarm %s, not installed', name)
+
+    thread = threading.Thread(target=run, name='prewarm')
+    thread.daemon = True
+    thread.start()
+    app.extensions['prewarm'] = thread
+    return thread
+
+
+def wait_prewarm(app):
+    """Waits for the prewarm thread. Forking while it holds the import lock
+    would leave the child unable to import anything."""
+    thread = app.extensions.get('prewarm')
+    if thread is not None:
+        thread.join()
+
+
+def peak_memory():
+    """Peak resident memory of this process in bytes."""
+    try:
+        # ru_maxrss of Linux keeps the parent's peak across fork and exec
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(config_name):
+    """Creates the app and returns the cold start figures, meaningful in a
+    fresh interpreter only."""
+    from . import create_app
+    before = set(sys.modules)
+    start = time.perf_counter()
+    app = create_app(config_name)
+    seconds = time.perf_counter() - start
+    wait_prewarm(app)
+    timer = app.extensions['startup']
+    return {'config': config_name,
+            'seconds': seconds,
+            'steps': timer.steps,
+            'peak_memory': peak_memory(),
+            'modules': sorted(set(name.split('.')[0] for name in
+                                  set(sys.modules) - before)),
+            'time_budget': app.config.get('STARTUP_TIME_BUDGET'),
+            'memory_budget': app.config.get('STARTUP_MEMORY_BUDGET')}
+
+
+def report(figures):
+    lines = ['create_app(%r) %.1f ms, peak memory %.1f MB' % (
+        figures['config'], figures['seconds'] * 1000,
+        figures['peak_memory'] / 2 ** 20)]
+    lines.extend('  %-16s %8.1f ms' % (name, seconds * 1000)
+                 for name, seconds in figures['steps'])
+    lines.append('imported: ' + ', '.join(figures['modules']))
+    if figures['time_budget'] is not None:
+        lines.append('budget: %.1f ms, %.1f MB' % (
+            figures['time_budget'] * 1000,
+            figures['memory_budget'] / 2 ** 20))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the cold start '
+                                     'time and memory of create_app.')
+    parser.add_argument('config', nargs='?',
+                        default=os.environ.get('FLASK_CONFIG', 'development'))
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    figures = measure(args.config)
+    print(json.dumps(figures) if args.json else report(figures))
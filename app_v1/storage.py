@@ -0,0 +1,82 @@
+'''
+SQLite storage profiles, selected with SQLITE_PROFILE in the config.
+
+A profile sets pragmas on every new connection of the application's engine
+(WAL, synchronous, busy_timeout, mmap_size, cache_size) and adds a separate
+pool of read-only connections that the GET routes use through
+read_session(), so reads run concurrently with the single writer instead of
+queueing behind its commits. Without a profile nothing changes and
+read_session() is db.session.
+
+synchronous=NORMAL in WAL mode does not sync the log on every commit: a
+committed transaction survives a crash of the process, not a power loss.
+With GROUP_COMMIT, whose acknowledgements promise the row is stored, the
+writer uses synchronous=FULL instead, the sync being paid once per batch.
+'''
+import sqlite3
+from flask import current_app
+from flask.globals import _app_ctx_stack
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from .__init__ import db
+
+profiles = {
+    'production': {
+        'pragmas': [('journal_mode', 'WAL'),
+                    ('synchronous', 'NORMAL'),
+                    ('busy_timeout', 5000),
+                    ('mmap_size', 256 * 1024 * 1024),
+                    ('cache_size', -64000)],  # in KiB
+        'read_pool_size': 8,
+    },
+}
+
+
+def set_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+            cursor.close()
+    return connect
+
+
+def init_app(app):
+    name = app.config.get('SQLITE_PROFILE')
+    if not name:
+        return
+    profile = profiles[name]
+    engine = db.get_engine(app)
+    if engine.url.drivername != 'sqlite':
+        return
+    pragmas = profile['pragmas']
+    if app.config.get('GROUP_COMMIT'):
+        pragmas = [('synchronous', 'FULL') if name == 'synchronous'
+                   else (name, value) for name, value in pragmas]
+    event.listen(engine, 'connect', set_pragmas(pragmas))
+
+    # journal_mode is a property of the database file, only the writer sets it
+    read_pragmas = [pragma for pragma in pragmas
+                    if pragma[0] != 'journal_mode'] + [('query_only', 1)]
+    read_engine = create_engine(
+        engine.url, poolclass=QueuePool,
+        pool_size=app.config.get('SQLITE_READ_POOL_SIZE',
+                                 profile['read_pool_size']),
+        connect_args={'check_same_thread': False})
+    event.listen(read_engine, 'connect', set_pragmas(read_pragmas))
+    session = scoped_session(sessionmaker(bind=read_engine),
+                             scopefunc=_app_ctx_stack.__ident_func__)
+    app.extensions['read_session'] = session
+
+    @app.teardown_appcontext
+    def remove_read_session(response_or_exc):
+        session.remove()
+        return response_or_exc
+
+
+def read_session():
+    """Session for queries of the GET routes."""
+    session = current_app.extensions.get('read_session')
+    return session if session is not None else db.session
@@ -0,0 +1,221 @@
+'''
+Computation engines for the calc-syllabus pivot: the mean normalised score
+(Answer / MaxAnswer) per UserId and Type, returned as {UserId: {Type: score}}.
+
+Types a user has no replies for are imputed with the mean score of that Type
+across the users in the pivot (the cohort), like pt.fillna(pt.mean()).
+
+materialized_pivot reads the SyllabusScore aggregates that update_scores
+keeps current on every filter reply write, so it costs O(#Types) per user.
+sql_pivot pushes the aggregation over the raw replies into the database so
+only the pivoted result comes back. pandas_pivot is the original DataFrame
+implementation, kept as the reference the other engines are checked against;
+it imports pandas on first use, see app_v1/startup.py.
+
+    python -m app_v1.syllabus [config name]
+
+recomputes the aggregates from scratch and reports how many had drifted.
+'''
+import os
+import re
+import sys
+
+from .models import FilterReply, SyllabusScore, ValidationError
+from .storage import read_session
+from .__init__ import db
+
+
+def impute(pivot):
+    columns = {}
+    for scores in pivot.values():
+        for Type, score in scores.items():
+            if score is not None:
+                columns.setdefault(Type, []).append(score)
+    means = dict((Type, sum(values) / len(values))
+                 for Type, values in columns.items())
+    filled = {}
+    for UserId, scores in pivot.items():
+        filled[UserId] = dict(means)
+        filled[UserId].update((Type, score) for Type, score in scores.items()
+                              if score is not None)
+    return filled
+
+
+# the columns of a filter reply that its aggregate depends on
+score_fields = ('CourseSoftwareId', 'UserId', 'Type', 'Answer', 'MaxAnswer')
+
+
+numeric_chars = frozenset('0123456789.eE+-')
+# the prefix CAST(text AS REAL) reads, 0.0 without one
+real_prefix = re.compile(r' *[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?')
+
+
+def number(value):
+    """Answer or MaxAnswer as the SQL engines read the text SQLite stores
+    for it (numeric()), None if it does not look like a number. The API
+    only accepts numbers (models.check_number), this is for rows written
+    around it."""
+    if value is None:
+        return None
+    text = value if isinstance(value, str) else str(value)
+    text = text.strip(' ')
+    if not text or not numeric_chars.issuperset(text) or \
+            not any(c.isdigit() for c in text):
+        return None
+    match = real_prefix.match(text)
+    return float(match.group()) if match else 0.0
+
+
+def numeric(column):
+    """SQL expression of the text column as a REAL where it looks like a
+    number, NULL elsewhere, the same test as number()."""
+    text = db.func.trim(column)
+    return db.case([(db.and_(text.op('GLOB')('*[0-9]*'),
+                             db.not_(text.op('GLOB')('*[^0-9.eE+-]*'))),
+                     db.cast(column, db.Float))])
+
+
+def score(row):
+    """Normalised score of a filter reply dict, None if it has none: a
+    missing or non-numeric Answer or MaxAnswer, or a MaxAnswer of 0 (the
+    SQL engines' division by 0.0 is NULL too and AVG skips it)."""
+    answer, maximum = number(row['Answer']), number(row['MaxAnswer'])
+    if answer is None or not maximum:
+        return None
+    return answer / maximum
+
+
+def update_scores(rows, sign=1):
+    """Adds (sign=1) or removes (sign=-1) the scores of filter reply dicts
+    to/from the SyllabusScore aggregates in the current transaction."""
+    deltas = {}
+    for row in rows:
+        value = score(row)
+        if value is None:
+            continue
+        key = (row['CourseSoftwareId'], row['UserId'], row['Type'])
+        total, count = deltas.get(key, (0.0, 0))
+        deltas[key] = (total + sign * value, count + sign)
+
+    if not deltas:
+        return
+    values = [{'CourseSoftwareId': key[0], 'UserId': key[1], 'Type': key[2],
+               'ScoreSum': total, 'ScoreCount': count}
+              for key, (total, count) in deltas.items()]
+    db.session.execute(upsert_score, values)
+    emptied = [value for value in values if value['ScoreCount'] < 0]
+    if emptied:
+        db.session.execute(delete_empty_score, emptied)
+
+
+# one executemany statement for all touched aggregates (SQLite >= 3.24)
+upsert_score = db.text(
+    'INSERT INTO syllabusScores '
+    '(CourseSoftwareId, UserId, Type, ScoreSum, ScoreCount) '
+    'VALUES (:CourseSoftwareId, :UserId, :Type, :ScoreSum, :ScoreCount) '
+    'ON CONFLICT (CourseSoftwareId, UserId, Type) DO UPDATE SET '
+    'ScoreSum = ScoreSum + excluded.ScoreSum, '
+    'ScoreCount = ScoreCount + excluded.ScoreCount')
+delete_empty_score = db.text(
+    'DELETE FROM syllabusScores WHERE CourseSoftwareId = :CourseSoftwareId '
+    'AND UserId = :UserId AND Type = :Type AND ScoreCount <= 0')
+
+
+def aggregate_query():
+    """SELECT of the SyllabusScore rows computed from the raw replies."""
+    value = numeric(FilterReply.Answer) / numeric(FilterReply.MaxAnswer)
+    return db.select([FilterReply.CourseSoftwareId, FilterReply.UserId,
+                      FilterReply.Type, db.func.sum(value),
+                      db.func.count(value)]) \
+        .group_by(FilterReply.CourseSoftwareId, FilterReply.UserId,
+                  FilterReply.Type) \
+        .having(db.func.count(value) > 0)
+
+
+def rebuild_scores(bind=None):
+    """Recomputes all aggregates from the raw replies. Returns the number of
+    aggregates that differed from the stored ones."""
+    bind = bind or db.session
+    table = SyllabusScore.__table__
+    stored = dict(((row[0], row[1], row[2]), (row[3], row[4]))
+                  for row in bind.execute(table.select()))
+    fresh = dict(((row[0], row[1], row[2]), (row[3], row[4]))
+                 for row in bind.execute(aggregate_query()))
+    drifted = 0
+    for key in set(stored) | set(fresh):
+        old, new = stored.get(key, (0.0, 0)), fresh.get(key, (0.0, 0))
+        if old[1] != new[1] or abs(old[0] - new[0]) > 1e-9:
+            drifted += 1
+    bind.execute(table.delete())
+    if fresh:
+        bind.execute(table.insert(), [
+            {'CourseSoftwareId': key[0], 'UserId': key[1], 'Type': key[2],
+             'ScoreSum': value[0], 'ScoreCount': value[1]}
+            for key, value in fresh.items()])
+    return drifted
+
+
+def materialized_pivot(CourseSoftwareId, UserIds=None):
+    query = read_session().query(SyllabusScore) \
+        .filter(SyllabusScore.CourseSoftwareId == CourseSoftwareId)
+    if UserIds is not None:
+        query = query.filter(SyllabusScore.UserId.in_(UserIds))
+    pivot = {}
+    for aggregate in query:
+        pivot.setdefault(aggregate.UserId, {})[aggregate.Type] = \
+            aggregate.ScoreSum / aggregate.ScoreCount
+    return impute(pivot)
+
+
+def sql_pivot(CourseSoftwareId, UserIds=None):
+    score = db.func.avg(numeric(FilterReply.Answer) /
+                        numeric(FilterReply.MaxAnswer))
+    query = read_session().query(FilterReply.UserId, FilterReply.Type, score) \
+        .filter(FilterReply.CourseSoftwareId == CourseSoftwareId)
+    if UserIds is not None:
+        query = query.filter(FilterReply.UserId.in_(UserIds))
+    pivot = {}
+    for UserId, Type, value in query.group_by(FilterReply.UserId,
+                                              FilterReply.Type):
+        pivot.setdefault(UserId, {})[Type] = value
+    return impute(pivot)
+
+
+def pandas_pivot(CourseSoftwareId, UserIds=None):
+    import pandas as pd
+    query = read_session().query(FilterReply) \
+        .filter_by(CourseSoftwareId=CourseSoftwareId)
+    if UserIds is not None:
+        query = query.filter(FilterReply.UserId.in_(UserIds))
+    rows = [result.export_data() for result in query]
+    filter_replies = pd.DataFrame.from_dict(rows)
+    if filter_replies.empty:
+        return {}
+    # score() rather than astype(float), which raises on text
+    filter_replies.Answer = pd.Series([score(row) for row in rows],
+                                      dtype=float)
+
+    pt = filter_replies.pivot_table(index='UserId', columns='Type', values='Answer')
+    pt_filled = pt.fillna(pt.mean())
+    return dict((UserId, row.to_dict()) for UserId, row in pt_filled.iterrows())
+
+
+engines = {'materialized': materialized_pivot, 'sql': sql_pivot,
+           'pandas': pandas_pivot}
+
+
+def compute_pivot(CourseSoftwareId, UserIds=None, engine='materialized'):
+    if engine not in engines:
+        raise ValidationError('Invalid engine, must be one of ' +
+                              ', '.join(sorted(engines)))
+    return engines[engine](CourseSoftwareId, UserIds)
+
+
+if __name__ == '__main__':
+    from . import create_app
+    app = create_app(sys.argv[1] if len(sys.argv) > 1 else
+                     os.environ.get('FLASK_CONFIG', 'development'))
+    with app.app_context():
+        drifted = rebuild_scores()
+        db.session.commit()
+        print('rebuilt syllabus scores, %d aggregates had drifted' % drifted)
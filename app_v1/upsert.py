@@ -0,0 +1,113 @@
+'''
+Modules are unique per (CourseSoftwareId, CourseMaterialId, UserId), the
+result of one user on one course material. PUT /modules/ records results
+by that key: one INSERT ... ON CONFLICT DO UPDATE per row (executemany for
+a batch) inserts the new ones and updates the others in place, keeping
+their id and CreatedDate, so concurrent writers cannot create duplicates.
+
+The module statistics are moved like for a PATCH: the new values are added
+first, which takes the write lock, then the values of the rows about to be
+replaced are read and removed. Within a batch the last row of a key wins.
+
+Databases created before the constraint may hold duplicates, the migration
+(merge_duplicates) keeps the most recently modified module of each key and
+deletes the others, leaving tombstones for the change feed.
+'''
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from .models import Module, Tombstone, ValidationError
+from .module_stats import update_stats, refresh_extremes, \
+    module_stat_fields, rebuild_stats
+from .__init__ import db
+
+key_fields = ('CourseSoftwareId', 'CourseMaterialId', 'UserId')
+# columns a PUT of an existing module overwrites
+update_fields = [column.key for column in Module.__table__.columns
+                 if column.key not in key_fields + ('id', 'CreatedDate')]
+insert_fields = [column.key for column in Module.__table__.columns
+                 if column.key != 'id']
+
+upsert_module = db.text(
+    'INSERT INTO modules (%s) VALUES (%s) '
+    'ON CONFLICT (%s) DO UPDATE SET %s' % (
+        ', '.join(insert_fields),
+        ', '.join(':' + name for name in insert_fields),
+        ', '.join(key_fields),
+        ', '.join('%s = excluded.%s' % (name, name)
+                  for name in update_fields))) \
+    .bindparams(*[db.bindparam(name, type_=Module.__table__.c[name].type)
+                  for name in insert_fields])
+
+duplicate_rows = db.text(
+    'SELECT id FROM (SELECT id, row_number() OVER (PARTITION BY %s '
+    'ORDER BY ModifiedDate DESC, id DESC) AS rank FROM modules WHERE %s) '
+    'WHERE rank > 1' % (', '.join(key_fields), ' AND '.join(
+        name + ' IS NOT NULL' for name in key_fields)))
+
+
+def module_key(values):
+    return tuple(values[name] for name in key_fields)
+
+
+@contextmanager
+def unique_module_key():
+    """Turns the violation of the key of modules by the writes in the block
+    into a ValidationError, after rolling the transaction back."""
+    try:
+        yield
+    except IntegrityError:
+        db.session.rollback()
+        raise ValidationError('Invalid module, there is one of this '
+                              'CourseSoftwareId, CourseMaterialId and UserId '
+                              'already, PUT /modules/ updates it')
+
+
+def find_modules(keys, chunk=300):
+    """The modules of the given keys, id, UserId and the columns of the
+    statistics only."""
+    rows = []
+    for start in range(0, len(keys), chunk):
+        rows += db.session.query(
+            Module.id, Module.UserId,
+            *[getattr(Module, name) for name in module_stat_fields]) \
+            .filter(db.or_(*[db.and_(*[getattr(Module, name) == value
+                                       for name, value in zip(key_fields, key)])
+                             for key in keys[start:start + chunk]])).all()
+    return rows
+
+
+def upsert_modules(values):
+    """Inserts or updates the module column values values by key in the
+    current transaction. Returns the ids in the order of values and the
+    number of modules created."""
+    if not values:
+        return [], 0
+    latest = OrderedDict((module_key(row), row) for row in values)
+    update_stats(list(latest.values()))
+    old = [row._asdict() for row in find_modules(list(latest))]
+    keys = update_stats(old, -1)
+    db.session.execute(upsert_module, list(latest.values()))
+    refresh_extremes(keys)
+    ids = dict((module_key(row._asdict()), row.id)
+               for row in find_modules(list(latest)))
+    return [ids[module_key(row)] for row in values], len(latest) - len(old)
+
+
+def merge_duplicates(bind):
+    """Deletes all modules but the most recently modified one of every key
+    and rebuilds the statistics if any were. Returns the number deleted."""
+    ids = [row[0] for row in bind.execute(duplicate_rows)]
+    if not ids:
+        return 0
+    table = Module.__table__
+    now = datetime.utcnow()
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        bind.execute(table.delete().where(table.c.id.in_(chunk)))
+        bind.execute(Tombstone.__table__.insert(), [
+            {'Table': table.name, 'RowId': id, 'DeletedDate': now}
+            for id in chunk])
+    rebuild_stats(bind)
+    return len(ids)
@@ -1,3 +1,8 @@
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
 from flask.globals import _app_ctx_stack, _request_ctx_stack
 from werkzeug.urls import url_parse
 from werkzeug.exceptions import NotFound
@@ -31,3 +36,104 @@ def split_url(url, method='GET'):
     except NotFound:
         raise ValidationError('Invalid URL: ' + url)
     return result
+
+
+
+iso_datetime = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+def parse_datetime(value):
+    """Parses ISO-8601 strictly and quickly, any other string (e.g. '22 Jan
+    2013') goes through dateutil. Returns the same datetime as dateutil,
+    ValueError for anything but a string."""
+    if not isinstance(value, str):
+        raise ValueError('not a date: %r' % (value,))
+    match = iso_datetime.match(value)
+    if match is None:
+        from dateutil import parser as datetime_parser
+        return datetime_parser.parse(value)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tzinfo = None
+    if offset == 'Z':
+        tzinfo = timezone.utc
+    elif offset:
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        tzinfo = timezone(timedelta(minutes=-minutes if offset[0] == '-'
+                                    else minutes))
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second), int(fraction.ljust(6, '0')) if fraction else 0,
+                    tzinfo)
+
+
+# a decimal number, which float() and SQLite's CAST(... AS REAL) read the same
+number_text = re.compile(r' *[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)? *$')
+
+
+def parse_number(value):
+    """float of an int, a float or a decimal string, ValueError for anything
+    else (booleans, 'n/a', '1_000', 'inf', ...)."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)) \
+            or isinstance(value, str) and not number_text.match(value):
+        raise ValueError('not a number: %r' % (value,))
+    value = float(value)
+    if value != value or value in (float('inf'), float('-inf')):
+        raise ValueError('not a number: %r' % (value,))
+    return value
+
+
+def format_datetime(value):
+    """isoformat() + 'Z' of a datetime, or of the string SQLite stores for
+    it ('2013-01-22 10:00:00.000000') without building the datetime."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat() + 'Z'
+    if len(value) == 26 and value[19] == '.':
+        if value.endswith('000000'):
+            return value[:10] + 'T' + value[11:19] + 'Z'
+        return value[:10] + 'T' + value[11:] + 'Z'
+    if len(value) == 19:
+        return value[:10] + 'T' + value[11:] + 'Z'
+    return parse_datetime(value).replace(tzinfo=None).isoformat() + 'Z'
+
+
+class TTLCache(object):
+    """Thread safe LRU cache bounded to maxsize entries, each of which
+    expires at the time given when it was stored."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, predicate):
+        """Removes every entry whose value matches predicate."""
+        with self._lock:
+            for key in [key for key, (expires, value) in self._data.items()
+                        if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
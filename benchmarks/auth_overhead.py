@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+'''
+Per-request cost of token authentication with and without the verified
+token cache.
+
+    python -m benchmarks.auth_overhead [requests]
+'''
+import sys
+from app_v1.models import User
+from tests.test_client import TestClient
+from .common import make_app, timed
+
+
+def verify(token, n, cache=None):
+    for i in range(n):
+        if cache is not None:
+            cache.clear()
+        User.verify_auth_token(token)
+
+
+def requests(client, n, cache=None):
+    for i in range(n):
+        if cache is not None:
+            cache.clear()
+        client.get('/modules/?limit=1')
+
+
+def main(n=2000):
+    app, client = make_app()
+    app.config['IGNORE_AUTH'] = False
+    token = User.query.get(1).generate_auth_token()
+    client = TestClient(app, token, '')
+    User.verify_auth_token(token)
+    cache = app.extensions['auth_token_cache']
+    for name, f, arg in (('verify_auth_token', verify, token),
+                         ('GET /modules/', requests, client)):
+        t_cold, _ = timed(f, arg, n, cache)
+        t_cached, _ = timed(f, arg, n)
+        print('%-18s uncached %8.1f us   cached %8.1f us' % (
+            name, t_cold * 1e6 / n, t_cached * 1e6 / n))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+'''
+Rows/s of the single-row POST path against the bulk (JSON array) path.
+
+    python -m benchmarks.bulk_insert [rows] [batch size]
+'''
+import sys
+from .common import make_app, timed, filter_reply_row, module_row
+
+
+def single(client, url, rows):
+    for row in rows:
+        client.post(url, data=row)
+
+
+def bulk(client, url, rows, batch):
+    for i in range(0, len(rows), batch):
+        client.post(url, data=rows[i:i + batch])
+
+
+def main(n=2000, batch=500):
+    app, client = make_app()
+    for url, make_row in (('/filterReplies/', filter_reply_row),
+                          ('/modules/', module_row)):
+        # other rows for the bulk path, modules are unique per key
+        rows = [make_row(i) for i in range(n)]
+        t_single, _ = timed(single, client, url, rows)
+        rows = [make_row(i) for i in range(n, 2 * n)]
+        t_bulk, _ = timed(bulk, client, url, rows, batch)
+        print('%-16s single %9.0f rows/s   bulk(%d) %9.0f rows/s   x%.1f' % (
+            url, n / t_single, batch, n / t_bulk, t_single / t_bulk))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+import os
+import time
+from datetime import datetime
+from app_v1 import create_app
+from app_v1.migrations import upgrade
+# the session the routes use, see the import of db in app_v1/models.py
+from app_v1.models import User, db
+from config.benchmark import db_path
+from tests.test_client import TestClient
+
+
+def make_app():
+    """Creates the benchmark app on a fresh database and returns it together
+    with a TestClient. Run from the repository root."""
+    db.session.remove()
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    app = create_app('benchmark')
+    ctx = app.app_context()
+    ctx.push()
+    upgrade()
+    u = User(username='john')
+    u.set_password('horsenosebattery')
+    db.session.add(u)
+    db.session.commit()
+    return app, TestClient(app, 'john', 'horsenosebattery')
+
+
+def filter_reply_row(i, users=100, courses=10, types=7):
+    return {'UserId': 'user%d' % (i % users),
+            'CourseSoftwareId': 'course%d' % (i // users % courses),
+            'Type': 'type%d' % (i // (users * courses) % types),
+            'Answer': i % 12, 'MaxAnswer': 12,
+            'CreatedDate': '2013-01-22T10:00:00',
+            'ModifiedDate': '2013-06-22T10:00:00'}
+
+
+def module_row(i, users=100, courses=10, materials=1000):
+    # a different (course, material, user) for every i below 1000000
+    return {'UserId': 'user%d' % (i % users),
+            'CourseSoftwareId': 'course%d' % (i // users % courses),
+            'CourseMaterialId': 'material%d' % (i // (users * courses) % materials),
+            'N2K': (i % 100) / 100.0, 'DAK': (i % 37) / 37.0,
+            'Included': i % 2, 'FilteredOut': int(i % 3 == 0),
+            'CreatedDate': '2013-01-22T10:00:00',
+            'ModifiedDate': '2013-06-22T10:00:00'}
+
+
+def populate(model, make_row, n, chunk=10000):
+    """Inserts n synthetic rows straight through Core, bypassing the API."""
+    for start in range(0, n, chunk):
+        values = []
+        for i in range(start, min(n, start + chunk)):
+            row = make_row(i)
+            for key in ('CreatedDate', 'ModifiedDate'):
+                row[key] = datetime.strptime(row[key], '%Y-%m-%dT%H:%M:%S')
+            values.append(row)
+        db.session.execute(model.__table__.insert(), values)
+    db.session.commit()
+
+
+def timed(f, *args, **kwargs):
+    """Returns (seconds, result) of calling f."""
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return time.perf_counter() - start, result
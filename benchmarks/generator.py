@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+Seeded synthetic Module and FilterReply data. The same seed and shape give
+the same rows, whatever the table size or chunking, so timings taken on
+different commits run against the same data.
+
+Activity is skewed like in real courses: a few users and courses account
+for most of the rows, answers are spread over the whole scale and the
+dates over one year.
+
+    python -m benchmarks.generator rows [seed]
+
+fills the benchmark database (config/benchmark.py) with rows of each.
+'''
+import random
+import sys
+from datetime import datetime, timedelta
+from itertools import islice
+from app_v1.models import Module, FilterReply, db
+from app_v1.syllabus import rebuild_scores
+from app_v1.module_stats import rebuild_stats
+
+START = datetime(2013, 1, 1)
+YEAR = 365 * 24 * 3600
+
+
+class Shape(object):
+    def __init__(self, users=1000, courses=50, types=7, materials=200):
+        self.users = users
+        self.courses = courses
+        self.types = types
+        self.materials = materials
+
+
+def skewed(rng, n):
+    # index in [0, n) with the low ones much more frequent
+    return int(n * rng.random() ** 2)
+
+
+def dates(rng):
+    created = START + timedelta(seconds=rng.randrange(YEAR))
+    return created, created + timedelta(seconds=rng.randrange(YEAR // 12))
+
+
+def filter_reply_rows(seed=0, shape=None):
+    """Endless sequence of FilterReply column values."""
+    shape = shape or Shape()
+    rng = random.Random(seed)
+    while True:
+        MaxAnswer = rng.choice((5, 10, 12, 20))
+        created, modified = dates(rng)
+        yield {'UserId': 'user%d' % skewed(rng, shape.users),
+               'CourseSoftwareId': 'course%d' % skewed(rng, shape.courses),
+               'Type': 'type%d' % rng.randrange(shape.types),
+               'Answer': rng.randint(0, MaxAnswer), 'MaxAnswer': MaxAnswer,
+               'CreatedDate': created, 'ModifiedDate': modified}
+
+
+def module_rows(seed=0, shape=None):
+    """Endless sequence of Module column values, one per user and course
+    material (modules are unique on them)."""
+    shape = shape or Shape()
+    rng = random.Random(seed)
+    seen = set()
+    while True:
+        created, modified = dates(rng)
+        row = {'UserId': 'user%d' % skewed(rng, shape.users),
+               'CourseSoftwareId': 'course%d' % skewed(rng, shape.courses),
+               'CourseMaterialId': 'material%d' % rng.randrange(shape.materials),
+               'N2K': round(rng.random(), 3), 'DAK': round(rng.random(), 3),
+               'Included': int(rng.random() < 0.8),
+               'FilteredOut': int(rng.random() < 0.1),
+               'CreatedDate': created, 'ModifiedDate': modified}
+        key = (row['UserId'], row['CourseSoftwareId'], row['CourseMaterialId'])
+        if key not in seen:
+            seen.add(key)
+            yield row
+
+
+generators = {Module: module_rows, FilterReply: filter_reply_rows}
+
+
+def load(model, n, seed=0, shape=None, chunk=50000):
+    """Inserts n generated rows of model straight through Core, one
+    transaction per chunk, and brings the syllabus aggregates and module
+    statistics up to date."""
+    rows = generators[model](seed, shape)
+    table = model.__table__
+    for start in range(0, n, chunk):
+        db.session.execute(table.insert(),
+                           list(islice(rows, min(chunk, n - start))))
+        db.session.commit()
+    if model is FilterReply:
+        rebuild_scores()
+        db.session.commit()
+    elif model is Module:
+        rebuild_stats()
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    from .common import make_app
+    app, client = make_app()
+    n = int(sys.argv[1])
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    load(Module, n, seed)
+    load(FilterReply, n, seed)
+    print('generated %d modules and %d filter replies' % (n, n))
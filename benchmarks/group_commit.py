@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+'''
+Single-row POST /filterReplies/ throughput from concurrent clients with
+per-request commits and with group commit at several batch windows.
+
+    python -m benchmarks.group_commit [clients] [seconds] [max rows]
+
+Set SQLITE_PROFILE=production to run it on the production storage profile.
+'''
+import sys
+import threading
+import time
+from app_v1.group_commit import init_app as init_group_commit
+from app_v1.models import db
+from tests.test_client import TestClient
+from .common import make_app, filter_reply_row
+
+LATENCIES = (0.001, 0.005, 0.02)
+
+
+def client_loop(client, start, deadline, latencies):
+    i = start
+    while time.perf_counter() < deadline:
+        t = time.perf_counter()
+        rv, json = client.post('/filterReplies/', data=filter_reply_row(i))
+        if rv.status_code == 201:
+            latencies.append(time.perf_counter() - t)
+        i += 1
+    # the routes' session of this thread, see benchmarks/common.py
+    db.session.remove()
+
+
+def run(name, app, clients, seconds):
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=client_loop, args=(
+        TestClient(app, 'john', 'horsenosebattery'), i * 10 ** 6, deadline,
+        latencies)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    print('%-22s %8.0f rows/s   p50 %7.2f ms   p99 %7.2f ms' % (
+        name, len(latencies) / seconds,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def main(clients=8, seconds=5, max_rows=500):
+    app, client = make_app()
+    run('per-request commit', app, clients, seconds)
+    for latency in LATENCIES:
+        app, client = make_app()
+        app.config.update(GROUP_COMMIT=True, GROUP_COMMIT_MAX_ROWS=max_rows,
+                          GROUP_COMMIT_MAX_LATENCY=latency)
+        init_group_commit(app)
+        run('group commit %4.1f ms' % (latency * 1000), app, clients, seconds)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''
+Latency of the lookup routes against table size, without and with the
+composite indexes built by app_v1.migrations.upgrade.
+
+    python -m benchmarks.lookup_indexes [rows ...]
+'''
+import sys
+from app_v1.migrations import upgrade
+from app_v1.models import Module, FilterReply, db
+from .common import make_app, timed, populate, filter_reply_row, module_row
+
+LOOKUPS = 200
+# the composite indexes of the lookup routes; ix_filterReplies_UserId is
+# older and stays in both runs
+lookup_indexes = ('ix_filterReplies_course_user',
+                  'uq_modules_course_material_user')
+
+
+def lookups(client):
+    for i in range(LOOKUPS):
+        row = filter_reply_row(i * 37)
+        client.get('/filterReplies/%s/%s' % (row['CourseSoftwareId'],
+                                             row['UserId']))
+        row = module_row(i * 37)
+        client.get('/module-id/%s/%s/%s' % (row['CourseSoftwareId'],
+                                            row['CourseMaterialId'],
+                                            row['UserId']))
+
+
+def main(sizes=(1000, 10000, 100000)):
+    for n in sizes:
+        app, client = make_app()
+        for table in (Module.__table__, FilterReply.__table__):
+            for index in table.indexes:
+                if index.name in lookup_indexes:
+                    index.drop(db.engine)
+        populate(FilterReply, filter_reply_row, n)
+        populate(Module, module_row, n)
+        t_scan, _ = timed(lookups, client)
+        upgrade()
+        t_index, _ = timed(lookups, client)
+        print('%9d rows   no index %8.3f ms/lookup   indexed %8.3f ms/lookup' % (
+            n, t_scan * 1000 / (2 * LOOKUPS), t_index * 1000 / (2 * LOOKUPS)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or (1000, 10000, 100000))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+'''
+Per-request cost of the /metrics instrumentation on a cheap and a SQL-heavy
+route.
+
+    python -m benchmarks.metrics_overhead [requests]
+'''
+import os
+import sys
+from app_v1.models import Module, FilterReply
+from .common import make_app, timed, populate, filter_reply_row, module_row
+
+
+def requests(client, url, n):
+    for i in range(n):
+        client.get(url)
+
+
+def main(n=2000):
+    results = {}
+    for metrics in ('0', '1'):
+        os.environ['METRICS'] = metrics
+        app, client = make_app()
+        populate(FilterReply, filter_reply_row, 10000)
+        populate(Module, module_row, 10000)
+        for url in ('/modules/1', '/modules/?limit=100',
+                    '/calc-syllabus/course1/user1'):
+            results[url, metrics] = timed(requests, client, url, n)[0]
+    for url in ('/modules/1', '/modules/?limit=100',
+                '/calc-syllabus/course1/user1'):
+        off, on = results[url, '0'], results[url, '1']
+        print('%-30s off %8.1f us   on %8.1f us   +%5.1f us' % (
+            url, off * 1e6 / n, on * 1e6 / n, (on - off) * 1e6 / n))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+'''
+Rows/s of the precompiled serializers against Model.export_data and
+Model.import_data.
+
+    python -m benchmarks.serializers [rows]
+'''
+import sys
+from app_v1.models import Module, FilterReply, db
+from app_v1.serializers import columns, encoder, decoder
+from .common import make_app, timed, populate, filter_reply_row, module_row
+
+
+def orm_encode(model):
+    return [row.export_data() for row in model.query.yield_per(1000)]
+
+
+def core_encode(model):
+    encode = encoder(model)
+    return [encode(row) for row in
+            db.session.query(*columns(model)).yield_per(1000)]
+
+
+def orm_decode(model, rows):
+    return [model().import_data(row) for row in rows]
+
+
+def core_decode(model, rows):
+    decode = decoder(model)
+    return [decode(row) for row in rows]
+
+
+def main(n=50000):
+    app, client = make_app()
+    for model, make_row in ((FilterReply, filter_reply_row),
+                            (Module, module_row)):
+        populate(model, make_row, n)
+        rows = [make_row(i) for i in range(n)]
+        t_old, _ = timed(orm_encode, model)
+        db.session.expunge_all()
+        t_new, _ = timed(core_encode, model)
+        print('%-12s encode   export_data %9.0f rows/s   encoder %9.0f rows/s' % (
+            model.__name__, n / t_old, n / t_new))
+        t_old, _ = timed(orm_decode, model, rows)
+        t_new, _ = timed(core_decode, model, rows)
+        print('%-12s decode   import_data %9.0f rows/s   decoder %9.0f rows/s' % (
+            model.__name__, n / t_old, n / t_new))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
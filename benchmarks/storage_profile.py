@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+Throughput of concurrent readers (GET routes) and writers (single-row POSTs)
+on the default SQLite setup and on the production storage profile (WAL,
+pragmas, read-only pool).
+
+    python -m benchmarks.storage_profile [readers] [writers] [seconds] [rows]
+'''
+import os
+import sys
+import threading
+import time
+from app_v1.models import Module, FilterReply, db
+from tests.test_client import TestClient
+from .common import make_app, populate, filter_reply_row, module_row
+
+
+def worker(client, request, deadline, counts, errors):
+    i = 0
+    while time.perf_counter() < deadline:
+        try:
+            rv, json = request(client, i)
+            if rv.status_code >= 400:
+                errors.append(rv.status_code)
+            else:
+                counts.append(1)
+        except Exception as e:
+            errors.append(type(e).__name__)
+        i += 1
+    # the routes' session of this thread, see benchmarks/common.py
+    db.session.remove()
+
+
+def read(n):
+    def request(client, i):
+        row = filter_reply_row(i * 37 % n)
+        if i % 2:
+            return client.get('/modules/%d' % (i * 37 % n + 1))
+        return client.get('/calc-syllabus/%s/%s' % (row['CourseSoftwareId'],
+                                                    row['UserId']))
+    return request
+
+
+def write(client, i):
+    return client.post('/filterReplies/', data=filter_reply_row(i))
+
+
+def run(profile, readers, writers, seconds, n):
+    os.environ['SQLITE_PROFILE'] = profile or ''
+    app, client = make_app()
+    populate(FilterReply, filter_reply_row, n)
+    populate(Module, module_row, n)
+
+    reads, writes, errors = [], [], []
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=worker, args=(
+        TestClient(app, 'john', 'horsenosebattery'), read(n), deadline,
+        reads, errors)) for i in range(readers)]
+    threads += [threading.Thread(target=worker, args=(
+        TestClient(app, 'john', 'horsenosebattery'), write, deadline,
+        writes, errors)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('%-10s %8.0f reads/s %8.0f writes/s %6d errors %s' % (
+        profile or 'default', len(reads) / seconds, len(writes) / seconds,
+        len(errors), ' '.join(sorted(set(map(str, errors))))))
+
+
+def main(readers=4, writers=2, seconds=5, n=20000):
+    for profile in (None, 'production'):
+        run(profile, readers, writers, seconds, n)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''
+Times every route of the API, token authentication included, on generated
+tables of several sizes and writes one JSON line per (size, route):
+
+    {"commit": ..., "size": 100000, "route": "GET /modules/<id>",
+     "iterations": 200, "errors": 0, "p50_ms": ..., "p99_ms": ...,
+     "mean_ms": ..., "throughput_rps": ..., "seed": 0, "users": 1000, ...}
+
+    python -m benchmarks.suite [--sizes 10000,100000] [--iterations 200]
+                               [--seed 0] [--users 1000] [--courses 50]
+                               [--types 7] [--materials 200] [--output FILE]
+    python -m benchmarks.suite --compare BASE.jsonl NEW.jsonl
+
+The data and the sequence of requests only depend on the seed and the
+shape, so two runs with the same arguments are comparable across commits.
+'''
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+from app_v1.models import User, Module, FilterReply, db
+from tests.test_client import TestClient
+from .common import make_app
+from .generator import Shape, load, filter_reply_rows, module_rows
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def measure(request, iterations):
+    latencies, errors = [], 0
+    for i in range(iterations):
+        start = time.perf_counter()
+        rv, body = request(i)
+        latencies.append(time.perf_counter() - start)
+        if rv.status_code >= 400:
+            errors += 1
+    latencies.sort()
+    total = sum(latencies)
+    return {'iterations': iterations, 'errors': errors,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_ms': total * 1000 / iterations,
+            'throughput_rps': iterations / total}
+
+
+def api_row(row):
+    return dict(row, CreatedDate=row['CreatedDate'].isoformat(),
+                ModifiedDate=row['ModifiedDate'].isoformat())
+
+
+def routes(app, n, seed, shape):
+    """(name, request(i), iterations factor) of every route, in the order
+    they are run. The rows created by the POSTs are patched and deleted
+    again."""
+    token = User.query.get(1).generate_auth_token()
+    client = TestClient(app, token, '')
+    basic = TestClient(app, 'john', 'horsenosebattery')
+    rng = random.Random(seed)
+    ids = [rng.randint(1, n) for i in range(1000)]
+    # plain tuples of the keys, ORM instances would be expired by the
+    # commits of the timed requests and reloaded inside the timings
+    modules = dict((m.id, m) for m in db.session.query(
+        Module.id, Module.CourseSoftwareId, Module.CourseMaterialId,
+        Module.UserId).filter(Module.id.in_(ids)))
+    replies = dict((r.id, r) for r in db.session.query(
+        FilterReply.id, FilterReply.CourseSoftwareId, FilterReply.UserId)
+        .filter(FilterReply.id.in_(ids)))
+
+    def pick(i, rows):
+        return rows[ids[i % len(ids)]]
+
+    # users of their own, the loaded modules have the same keys
+    new_modules = (dict(row, UserId='new-' + row['UserId'])
+                   for row in module_rows(seed + 1, shape))
+    new_replies = filter_reply_rows(seed + 1, shape)
+    created = {'/modules/': [], '/filterReplies/': []}
+
+    def post(url, rows):
+        def request(i):
+            rv, body = client.post(url, data=api_row(next(rows)))
+            created[url].append(str(rv.headers['Location']).split('/')[-1])
+            return rv, body
+        return request
+
+    def bulk(url, rows):
+        def request(i):
+            rv, body = client.post(url, data=[api_row(next(rows))
+                                              for j in range(100)])
+            created[url].extend(body['ids'])
+            return rv, body
+        return request
+
+    def patch(url):
+        return lambda i: client.patch('%s%s' % (url, created[url][i]),
+                                      {'N2K': 0.5} if 'modules' in url
+                                      else {'Answer': 1})
+
+    def delete(url):
+        return lambda i: client.delete('%s%s' % (url, created[url].pop()))
+
+    return [
+        ('GET /get-auth-token', lambda i: basic.get('/get-auth-token'), 0.1),
+        ('GET /modules/', lambda i: client.get('/modules/'), 1),
+        ('GET /modules/?fields', lambda i: client.get(
+            '/modules/?fields=UserId,N2K,DAK'), 1),
+        ('GET /modules/<id>', lambda i: client.get(
+            '/modules/%d' % pick(i, modules).id), 1),
+        ('GET /module-id/<csi>/<cmi>/<user>', lambda i: client.get(
+            '/module-id/%s/%s/%s' % (pick(i, modules).CourseSoftwareId,
+                                     pick(i, modules).CourseMaterialId,
+                                     pick(i, modules).UserId)), 1),
+        ('GET /modules/stats/<csi>', lambda i: client.get(
+            '/modules/stats/%s' % pick(i, modules).CourseSoftwareId), 1),
+        ('POST /modules/', post('/modules/', new_modules), 1),
+        ('POST /modules/ (bulk 100)', bulk('/modules/', new_modules), 0.1),
+        ('PATCH /modules/<id>', patch('/modules/'), 1),
+        ('DELETE /modules/<id>', delete('/modules/'), 1),
+        ('GET /filterReplies/', lambda i: client.get('/filterReplies/'), 1),
+        ('GET /filterReplies/<id>', lambda i: client.get(
+            '/filterReplies/%d' % pick(i, replies).id), 1),
+        ('GET /filterReplies/<csi>/<user>', lambda i: client.get(
+            '/filterReplies/%s/%s' % (pick(i, replies).CourseSoftwareId,
+                                      pick(i, replies).UserId)), 1),
+        ('POST /filterReplies/', post('/filterReplies/', new_replies), 1),
+        ('POST /filterReplies/ (bulk 100)',
+         bulk('/filterReplies/', new_replies), 0.1),
+        ('PATCH /filterReplies/<id>', patch('/filterReplies/'), 1),
+        ('DELETE /filterReplies/<id>', delete('/filterReplies/'), 1),
+        ('GET /calc-syllabus/<csi>/<user>', lambda i: client.get(
+            '/calc-syllabus/%s/%s' % (pick(i, replies).CourseSoftwareId,
+                                      pick(i, replies).UserId)), 1),
+        ('GET /calc-syllabus/<csi>/<user>?engine=sql', lambda i: client.get(
+            '/calc-syllabus/%s/%s?engine=sql' % (
+                pick(i, replies).CourseSoftwareId, pick(i, replies).UserId)),
+         1),
+        ('GET /calc-syllabus/<csi>', lambda i: client.get(
+            '/calc-syllabus/%s' % pick(i, replies).CourseSoftwareId), 0.1),
+    ]
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL) \
+            .decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, iterations, seed, shape, output):
+    revision = commit()
+    for n in sizes:
+        app, client = make_app()
+        app.config['IGNORE_AUTH'] = False
+        start = time.perf_counter()
+        load(Module, n, seed, shape)
+        load(FilterReply, n, seed, shape)
+        print('loaded %d rows per table in %.1f s' % (
+            n, time.perf_counter() - start), file=sys.stderr)
+        for name, request, factor in routes(app, n, seed, shape):
+            result = measure(request, max(1, int(iterations * factor)))
+            result.update(shape.__dict__, commit=revision, size=n,
+                          route=name, seed=seed)
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+        db.session.remove()
+
+
+def compare(base, new):
+    """Prints the p50/p99 of new relative to base for every (size, route)
+    found in both."""
+    def read(path):
+        with open(path) as f:
+            return dict(((r['size'], r['route']), r) for r in map(json.loads, f))
+    base, new = read(base), read(new)
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        print('%9d %-45s p50 %8.2f -> %8.2f ms (x%.2f)   p99 %8.2f -> %8.2f ms'
+              % (key[0], key[1], b['p50_ms'], n['p50_ms'],
+                 n['p50_ms'] / b['p50_ms'], b['p99_ms'], n['p99_ms']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10000,100000')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--courses', type=int, default=50)
+    parser.add_argument('--types', type=int, default=7)
+    parser.add_argument('--materials', type=int, default=200)
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    args = parser.parse_args(argv)
+    if args.compare:
+        return compare(*args.compare)
+    shape = Shape(args.users, args.courses, args.types, args.materials)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.output:
+        with open(args.output, 'w') as output:
+            run(sizes, args.iterations, args.seed, shape, output)
+    else:
+        run(sizes, args.iterations, args.seed, shape, sys.stdout)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+Throughput of the pre-forked server (app_v1/server.py) by number of workers,
+with client processes sending requests over HTTP.
+
+    python -m benchmarks.workers [seconds] [clients] [max workers]
+'''
+import base64
+import http.client
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from app_v1.models import Module, FilterReply, db
+from app_v1.server import serve
+from .common import make_app, populate, filter_reply_row, module_row
+
+urls = ['/modules/%d' % i for i in range(1, 101)] + \
+       ['/calc-syllabus/course%d/user%d' % (i % 10, i) for i in range(100)]
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def client(port, seconds, results):
+    # SERVER_NAME and user of the benchmark app
+    headers = {'Host': 'example.com',
+               'Authorization': 'Basic ' + base64.b64encode(
+                   b'john:horsenosebattery').decode('ascii')}
+    done = 0
+    deadline = time.time() + seconds
+    try:
+        while time.time() < deadline:
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', urls[done % len(urls)], headers=headers)
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            if response.status != 200:
+                raise RuntimeError('%s: %d' % (urls[done % len(urls)],
+                                               response.status))
+            done += 1
+    finally:
+        results.put(done)
+
+
+def run(app, workers, seconds, clients):
+    port = free_port()
+    app.config.update(WORKERS=workers, LISTEN='127.0.0.1:%d' % port)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(app)
+        finally:
+            os._exit(0)
+    try:
+        wait_for(port)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client,
+                                             args=(port, seconds, results))
+                     for i in range(clients)]
+        for process in processes:
+            process.start()
+        done = sum(results.get() for process in processes)
+        for process in processes:
+            process.join()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    return done / seconds
+
+
+def main(seconds=5, clients=8, max_workers=None):
+    max_workers = max_workers or 2 * (os.cpu_count() or 1)
+    # no access log
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app, test_client = make_app()
+    populate(FilterReply, filter_reply_row, 10000)
+    populate(Module, module_row, 10000)
+    db.session.remove()
+    print('%d cores, %d clients' % (os.cpu_count() or 1, clients))
+    workers = 1
+    while workers <= max_workers:
+        print('%3d workers %8.0f req/s' % (
+            workers, run(app, workers, seconds, clients)))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
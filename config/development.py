@@ -6,5 +6,38 @@ db_path = os.path.join(basedir, '../data.sqlite')
 DEBUG = True
 IGNORE_AUTH = True
 SECRET_KEY = 'top-secret!'
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_MULTI_GET = 1000  # ids per GET /modules/?ids=
+EXPORT_CHUNK_SIZE = 1000
+SNAPSHOT_CHUNK_SIZE = 65536
+FEED_TOMBSTONE_DAYS = 30  # days a deletion stays in the change feed
+SYLLABUS_ENGINE = 'materialized'
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 300
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE')
+GROUP_COMMIT = bool(os.environ.get('GROUP_COMMIT'))
+GROUP_COMMIT_MAX_ROWS = 500
+GROUP_COMMIT_MAX_LATENCY = 0.005  # seconds
+GROUP_COMMIT_TIMEOUT = 5.0
+METRICS = True
+METRICS_DIR = os.environ.get('METRICS_DIR')  # with WORKERS, default: a tmp dir
+METRICS_SAVE_INTERVAL = 1.0  # seconds
+METRICS_ALLOW = ['127.0.0.1', '::1']  # clients reading /metrics without a token
+SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG') and \
+    float(os.environ['SLOW_REQUEST_LOG'])  # seconds
+COMPRESSION = True
+COMPRESSION_MIN_SIZE = 500  # bytes
+COMPRESSION_LEVEL = 6
+COMPRESSION_CACHE_SIZE = 1024
+COMPRESSION_CACHE_TTL = 300  # seconds
+WORKERS = int(os.environ.get('WORKERS', 0))  # 0: Flask's server
+THREADS = int(os.environ.get('THREADS', 1))
+MAX_REQUESTS = 0  # 0: workers are not recycled
+MAX_REQUESTS_JITTER = 0
+LISTEN = os.environ.get('LISTEN', '127.0.0.1:5000')
+PREWARM_IMPORTS = []  # e.g. ['pandas'], see app_v1/startup.py
+STARTUP_TIME_BUDGET = 0.5  # seconds
+STARTUP_MEMORY_BUDGET = 80 * 2 ** 20  # bytes
 SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                           'sqlite:///' + db_path
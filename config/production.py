@@ -0,0 +1,44 @@
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+db_path = os.path.join(basedir, '../data.sqlite')
+
+DEBUG = False
+IGNORE_AUTH = False
+SECRET_KEY = os.environ.get('SECRET_KEY')  # required, signs the auth tokens
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_MULTI_GET = 1000  # ids per GET /modules/?ids=
+EXPORT_CHUNK_SIZE = 1000
+SNAPSHOT_CHUNK_SIZE = 65536
+FEED_TOMBSTONE_DAYS = 30  # days a deletion stays in the change feed
+SYLLABUS_ENGINE = 'materialized'
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 300
+SQLITE_PROFILE = 'production'
+SQLITE_READ_POOL_SIZE = 8
+GROUP_COMMIT = bool(os.environ.get('GROUP_COMMIT'))
+GROUP_COMMIT_MAX_ROWS = 500
+GROUP_COMMIT_MAX_LATENCY = 0.005  # seconds
+GROUP_COMMIT_TIMEOUT = 5.0
+METRICS = True
+METRICS_DIR = os.environ.get('METRICS_DIR')  # with WORKERS, default: a tmp dir
+METRICS_SAVE_INTERVAL = 1.0  # seconds
+METRICS_ALLOW = ['127.0.0.1', '::1']  # clients reading /metrics without a token
+SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG') and \
+    float(os.environ['SLOW_REQUEST_LOG'])  # seconds
+COMPRESSION = True
+COMPRESSION_MIN_SIZE = 500  # bytes
+COMPRESSION_LEVEL = 6
+COMPRESSION_CACHE_SIZE = 1024
+COMPRESSION_CACHE_TTL = 300  # seconds
+WORKERS = int(os.environ.get('WORKERS') or os.cpu_count() or 1)
+THREADS = int(os.environ.get('THREADS', 4))
+MAX_REQUESTS = 10000  # 0: workers are not recycled
+MAX_REQUESTS_JITTER = 1000
+LISTEN = os.environ.get('LISTEN', '0.0.0.0:5000')
+PREWARM_IMPORTS = ['pandas', 'dateutil.parser']
+STARTUP_TIME_BUDGET = 0.5  # seconds
+STARTUP_MEMORY_BUDGET = 80 * 2 ** 20  # bytes
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+                          'sqlite:///' + db_path
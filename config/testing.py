@@ -7,5 +7,34 @@ DEBUG = False
 TESTING = True
 IGNORE_AUTH = False
 SECRET_KEY = 'top-secret!'
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_MULTI_GET = 1000  # ids per GET /modules/?ids=
+EXPORT_CHUNK_SIZE = 1000
+SNAPSHOT_CHUNK_SIZE = 65536
+FEED_TOMBSTONE_DAYS = 30  # days a deletion stays in the change feed
+SYLLABUS_ENGINE = 'materialized'
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 300
+SQLITE_PROFILE = None
+GROUP_COMMIT = False
+METRICS = True
+METRICS_DIR = None
+METRICS_SAVE_INTERVAL = 1.0  # seconds
+METRICS_ALLOW = ['127.0.0.1', '::1']  # clients reading /metrics without a token
+SLOW_REQUEST_LOG = None  # seconds
+COMPRESSION = True
+COMPRESSION_MIN_SIZE = 500  # bytes
+COMPRESSION_LEVEL = 6
+COMPRESSION_CACHE_SIZE = 1024
+COMPRESSION_CACHE_TTL = 300  # seconds
 SERVER_NAME = 'example.com'
+WORKERS = 0  # 0: Flask's server
+THREADS = 1
+MAX_REQUESTS = 0  # 0: workers are not recycled
+MAX_REQUESTS_JITTER = 0
+LISTEN = '127.0.0.1:5000'
+PREWARM_IMPORTS = []
+STARTUP_TIME_BUDGET = 0.5  # seconds
+STARTUP_MEMORY_BUDGET = 80 * 2 ** 20  # bytes
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Loads a CSV or Parquet file into the modules or filterReplies table without
+going through the API.
+
+    python load.py modules data/modules.csv
+    python load.py filterReplies replies.parquet --chunksize 100000 \\
+        --drop-indexes --checkpoint replies.checkpoint
+
+The columns are those of the API's JSON (UserId, CourseSoftwareId, ...).
+Invalid rows are skipped and reported on stderr with their row number. With
+--checkpoint, rerunning the same command after an interruption resumes
+after the last committed chunk.
+'''
+import argparse
+import os
+import sys
+from app_v1.__init__ import create_app, db
+from app_v1.loader import models, load_file, drop_indexes
+from app_v1.migrations import upgrade
+
+
+def progress(rows, inserted, seconds):
+    sys.stderr.write('\r%d rows read, %d inserted, %.0f rows/s' % (
+        rows, inserted, inserted / seconds if seconds else 0))
+    sys.stderr.flush()
+
+
+def error(index, message):
+    sys.stderr.write('\nrow %d: %s\n' % (index, message))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load a CSV or '
+                                     'Parquet file into a table.')
+    parser.add_argument('table', choices=sorted(models))
+    parser.add_argument('path')
+    parser.add_argument('--chunksize', type=int, default=50000,
+                        help='rows per transaction')
+    parser.add_argument('--checkpoint',
+                        help='file recording the progress, to resume from')
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='drop the indexes during the load and '
+                             'rebuild them afterwards')
+    parser.add_argument('--config',
+                        default=os.environ.get('FLASK_CONFIG', 'development'))
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        db.create_all()
+        upgrade()
+        model = models[args.table]
+        if args.drop_indexes:
+            drop_indexes(model)
+        try:
+            rows, inserted, invalid = load_file(
+                model, args.path, args.chunksize, args.checkpoint,
+                progress, error)
+        finally:
+            if args.drop_indexes:
+                sys.stderr.write('\nrebuilding indexes\n')
+                upgrade()
+        sys.stderr.write('\n%d rows read, %d inserted, %d invalid\n' % (
+            rows, inserted, invalid))
@@ -3,6 +3,7 @@ import os
 from app_v1.__init__ import create_app, db
 from flask.ext.sqlalchemy import SQLAlchemy
 from app_v1.models import User
+from app_v1.migrations import upgrade
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, '../data.sqlite')
@@ -12,15 +13,31 @@ DEBUG = True
 IGNORE_AUTH = True
 SECRET_KEY = 'top-secret!'
 
-if __name__ == '__main__':
-    app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+
+def setup(app):
     with app.app_context():
         db = SQLAlchemy()
         db.create_all()
+        upgrade()
         # create a development user
         if User.query.get(1) is None:
             u = User(username='john')
             u.set_password('horsenosebattery')
             db.session.add(u)
             db.session.commit()
-    app.run()
+
+
+def factory():
+    app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+    setup(app)
+    return app
+
+
+if __name__ == '__main__':
+    app = factory()
+    if app.config.get('WORKERS'):
+        # pre-forked workers, see app_v1/server.py
+        from app_v1.server import serve
+        serve(app, factory)
+    else:
+        app.run()
@@ -18,11 +18,11 @@ class TestClient():
         # append the autnentication headers to all requests
         headers = headers.copy()
         headers['Authorization'] = self.auth
-        headers['Content-Type'] = 'application/json'
-        headers['Accept'] = 'application/json'
+        headers.setdefault('Content-Type', 'application/json')
+        headers.setdefault('Accept', 'application/json')
 
-        # convert JSON data to a string
-        if data:
+        # convert JSON data to a string, raw bodies (e.g. NDJSON) go as is
+        if data and not isinstance(data, str):
             data = json.dumps(data)
 
         # send request to the test client and return the response
@@ -33,7 +33,13 @@ class TestClient():
                 rv = self.app.dispatch_request()
             rv = self.app.make_response(rv)
             rv = self.app.process_response(rv)
-            return rv, json.loads(rv.data.decode('utf-8'))
+            if rv.headers.get('Content-Encoding'):
+                # compressed, left to the test
+                return rv, rv.data
+            body = rv.data.decode('utf-8')
+            if rv.mimetype == 'application/json' and body:
+                body = json.loads(body)
+            return rv, body
 
     def get(self, url, headers={}):
         return self.send(url, 'GET', headers=headers)
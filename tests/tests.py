@@ -1,7 +1,35 @@
+import gzip
+import http.client
+import io
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import threading
+import zlib
+import json as json_module
+from datetime import datetime, timedelta
 from werkzeug.exceptions import NotFound
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
 from app_v1 import create_app, db
-from app_v1.models import User, ValidationError
+from app_v1.models import User, Module, FilterReply, Tombstone, ValidationError, \
+    bump_user_version, db as routes_db
+from app_v1.serializers import columns, encoder, decoder
+from app_v1.migrations import upgrade
+from app_v1.storage import init_app as init_storage, read_session
+from app_v1.group_commit import init_app as init_group_commit
+from app_v1.loader import load_file, drop_indexes
+from app_v1.snapshot import snapshot_parts, pyarrow_available
+from app_v1.server import serve, listen, parse_address
+from app_v1.syllabus import sql_pivot, pandas_pivot, materialized_pivot, \
+    rebuild_scores, update_scores
+from app_v1.module_stats import rebuild_stats
 from .test_client import TestClient
 
 
@@ -15,11 +43,13 @@ class TestAPI(unittest.TestCase):
         self.ctx.push()
         db.drop_all()
         db.create_all()
+        upgrade()
         u = User(username=self.default_username)
         u.set_password(self.default_password)
         db.session.add(u)
         db.session.commit()
-        self.client = TestClient(self.app, u.generate_auth_token(), '') # u.generate_auth_token()
+        self.token = u.generate_auth_token()
+        self.client = TestClient(self.app, self.token, '') # u.generate_auth_token()
 
     def tearDown(self):
         db.session.remove()
@@ -130,6 +160,974 @@ class TestAPI(unittest.TestCase):
         location = '/filterReplies/' + str(json['filterReplies'][0]['id'])
         self.client.delete(location)
 
+    def test_bulk_insert(self):
+        rows = [{'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb', 'Type': 'AOI',
+                 'Answer': 5, 'MaxAnswer': 12, 'CreatedDate': '22 Jan 2013',
+                 'ModifiedDate': '22 Jun 2013'} for i in range(3)]
+        rows.insert(1, {'UserId': 'aaaa'})
+        rv, json = self.client.post('/filterReplies/', data=rows)
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(len(json['ids']) == 3)
+        self.assertTrue(json['errors'][0]['index'] == 1)
+        reply_ids = json['ids']
+        rv, reply = self.client.get('/filterReplies/' + str(reply_ids[2]))
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(reply['Type'] == 'AOI')
+
+        # all rows invalid
+        rv, json = self.client.post('/filterReplies/', data=[{'UserId': 'x'}])
+        self.assertTrue(rv.status_code == 400)
+        self.assertTrue(json['ids'] == [])
+
+        # NDJSON body for modules
+        module = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                  'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                  'Included': 1, 'FilteredOut': 0,
+                  'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        body = '\n'.join(json_module.dumps(dict(module, UserId='u%d' % i))
+                         for i in range(2)) + '\nnot json\n'
+        rv, json = self.client.send('/modules/', 'POST', body,
+                                    headers={'Content-Type': 'application/x-ndjson'})
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(len(json['ids']) == 2)
+        self.assertTrue(json['errors'][0]['index'] == 2)
+        rv, json = self.client.get('/modules/')
+        self.assertTrue(len(json['module ids']) == 2)
+
+        for id in json['module ids']:
+            self.client.delete('/modules/' + str(id))
+        for id in reply_ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_group_commit(self):
+        self.app.config['GROUP_COMMIT'] = True
+        init_group_commit(self.app)
+        row = {'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb', 'Type': 'AOI',
+               'Answer': 5, 'MaxAnswer': 12, 'CreatedDate': '22 Jan 2013',
+               'ModifiedDate': '22 Jun 2013'}
+        ids = []
+
+        def post(i):
+            client = TestClient(self.app, self.token, '')
+            rv, json = client.post('/filterReplies/', data=dict(row, Answer=i))
+            ids.append((i, rv.headers['Location']))
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(set(id for i, id in ids)) == 8)
+        for i, id in ids:
+            rv, json = self.client.get('/filterReplies/' + str(id))
+            self.assertTrue(json['Answer'] == i)
+
+        with self.assertRaises(ValidationError):
+            self.client.post('/filterReplies/', data={'UserId': 'aaaa'})
+
+        # a request timing out before its batch is written cancels its row
+        writer = self.app.extensions['group_commit']
+        writer.max_latency, writer.timeout = 0.5, 0.05
+        with self.assertRaises(RuntimeError):
+            writer.submit(decoder(FilterReply)(dict(row, UserId='cancelled')))
+        writer.max_latency, writer.timeout = 0.005, 5.0
+        # written in the same batch at the earliest
+        ids.append((5, writer.submit(decoder(FilterReply)(row))))
+        self.assertTrue(FilterReply.query.filter_by(UserId='cancelled').count() == 0)
+        for i, id in ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_bulk_loader(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'modules.csv')
+        checkpoint = os.path.join(directory, 'modules.checkpoint')
+        with open(path, 'w') as f:
+            f.write('UserId,CourseSoftwareId,CourseMaterialId,N2K,DAK,'
+                    'Included,FilteredOut,CreatedDate,ModifiedDate\n'
+                    'aaaaa,ExcelYYY,bbbbb,0.25,0.32,1,0,22 Jan 2013,23 Jun 2013\n'
+                    'zzzzz,ExcelYYY,bbbbb,0.25,0.32,1,0,22 Jan 2013,\n'
+                    'bbbbb,ExcelYYY,ccccc,0.5,0.1,0,1,2013-01-22,2013-06-23\n')
+        errors = []
+        rows, inserted, invalid = load_file(
+            Module, path, chunksize=2, checkpoint=checkpoint,
+            errors=lambda index, message: errors.append(index))
+        self.assertTrue((rows, inserted, invalid) == (3, 2, 1))
+        self.assertTrue(errors == [1])
+        rv, json = self.client.get('/modules/?fields=UserId')
+        self.assertTrue([m['UserId'] for m in json['modules']] ==
+                        ['aaaaa', 'bbbbb'])
+
+        # resuming a finished load inserts nothing
+        self.assertTrue(load_file(Module, path, chunksize=2,
+                                  checkpoint=checkpoint) == (3, 0, 0))
+        for module in json['modules']:
+            self.client.delete('/modules/' + str(module['id']))
+        shutil.rmtree(directory)
+
+    def test_bulk_loader_resume(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'modules.csv')
+        checkpoint = os.path.join(directory, 'modules.checkpoint')
+        with open(path, 'w') as f:
+            f.write('UserId,CourseSoftwareId,CourseMaterialId,N2K,DAK,'
+                    'Included,FilteredOut,CreatedDate,ModifiedDate\n' +
+                    ''.join('u%d,ExcelYYY,bbbbb,0.25,0.32,1,0,2013-01-22,'
+                            '2013-06-23\n' % i for i in range(5)))
+
+        def interrupt(rows, inserted, seconds):
+            raise KeyboardInterrupt
+        drop_indexes(Module)
+        with self.assertRaises(KeyboardInterrupt):
+            load_file(Module, path, chunksize=2, checkpoint=checkpoint,
+                      progress=interrupt)
+
+        # rerunning the command drops the indexes again and goes on after
+        # the committed chunk
+        drop_indexes(Module)
+        self.assertTrue(load_file(Module, path, chunksize=2,
+                                  checkpoint=checkpoint) == (5, 3, 0))
+        self.assertTrue('uq_modules_course_material_user' in upgrade())
+        rv, json = self.client.get('/modules/?fields=UserId')
+        self.assertTrue([m['UserId'] for m in json['modules']] ==
+                        ['u%d' % i for i in range(5)])
+        for module in json['modules']:
+            self.client.delete('/modules/' + str(module['id']))
+        shutil.rmtree(directory)
+
+    def test_snapshot(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.post('/modules/', data=[
+            module_data, dict(module_data, UserId='ccccc',
+                              ModifiedDate='2013-07-01T10:00:00')])
+        ids = json['ids']
+
+        rv, text = self.client.get('/modules/snapshot?format=csv')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'text/csv')
+        lines = text.splitlines()
+        self.assertTrue(lines[0].startswith('id,UserId,'))
+        self.assertTrue(len(lines) == 3)
+        self.assertTrue('2013-06-23T00:00:00Z' in lines[1])
+        rv, text = self.client.get(
+            '/modules/snapshot?format=csv&since=2013-06-30T00:00:00Z')
+        self.assertTrue(len(text.splitlines()) == 2)
+        with self.assertRaises(ValidationError):
+            self.client.get('/modules/snapshot?format=xls')
+
+        if pyarrow_available():
+            import pyarrow.parquet as pq
+            sink = io.BytesIO()
+            for count in snapshot_parts(Module, sink, 'parquet', chunk_size=1):
+                pass
+            table = pq.read_table(io.BytesIO(sink.getvalue()))
+            self.assertTrue(table.num_rows == 2)
+            self.assertTrue(str(table.schema.field('N2K').type) == 'double')
+            self.assertTrue(str(table.schema.field('ModifiedDate').type) ==
+                            'timestamp[us]')
+            self.assertTrue(table.column('ModifiedDate')[1].as_py().month == 7)
+        for id in ids:
+            self.client.delete('/modules/' + str(id))
+
+    def test_compression(self):
+        rows = [{'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb', 'Type': 'AOI',
+                 'Answer': i % 12, 'MaxAnswer': 12, 'CreatedDate': '22 Jan 2013',
+                 'ModifiedDate': '22 Jun 2013'} for i in range(30)]
+        rv, json = self.client.post('/filterReplies/', data=rows)
+        ids = json['ids']
+        rv, plain = self.client.get('/filterReplies/')
+        self.assertTrue('Content-Encoding' not in rv.headers)
+
+        rv, body = self.client.get('/filterReplies/',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(rv.headers['Content-Encoding'] == 'gzip')
+        self.assertTrue('Accept-Encoding' in rv.headers['Vary'])
+        self.assertTrue(json_module.loads(gzip.decompress(body).decode()) == plain)
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        # the second request is answered from the memoised body
+        cache = self.app.extensions['compression']['cache']
+        self.assertTrue(len(cache._data) == 1)
+        rv, again = self.client.get('/filterReplies/',
+                                    headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(again == body and rv.headers['ETag'] == etag)
+        rv, body = self.client.get('/filterReplies/',
+                                   headers={'If-None-Match': etag,
+                                            'Accept-Encoding': 'gzip'})
+        self.assertTrue(rv.status_code == 304)
+
+        rv, body = self.client.get('/filterReplies/',
+                                   headers={'Accept-Encoding': 'deflate, gzip;q=0.5'})
+        self.assertTrue(rv.headers['Content-Encoding'] == 'deflate')
+        self.assertTrue(json_module.loads(zlib.decompress(body).decode()) == plain)
+        rv, body = self.client.get('/filterReplies/',
+                                   headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertTrue('Content-Encoding' not in rv.headers)
+
+        # small bodies go uncompressed, streamed ones always compressed
+        rv, body = self.client.get('/filterReplies/%d?fields=UserId' % ids[0],
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue('Content-Encoding' not in rv.headers)
+        rv, plain = self.client.get('/filterReplies/export')
+        rv, body = self.client.get('/filterReplies/export',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(rv.headers['Content-Encoding'] == 'gzip')
+        self.assertTrue(gzip.decompress(body).decode() == plain)
+        for id in ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_pagination(self):
+        rows = [{'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb', 'Type': 'AOI',
+                 'Answer': i, 'MaxAnswer': 12, 'CreatedDate': '22 Jan 2013',
+                 'ModifiedDate': '22 Jun 2013'} for i in range(5)]
+        rv, json = self.client.post('/filterReplies/', data=rows)
+        ids = json['ids']
+
+        rv, json = self.client.get('/filterReplies/?limit=2')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([r['id'] for r in json['filterReplies']] == ids[:2])
+        rv, json = self.client.get(json['next'])
+        self.assertTrue([r['id'] for r in json['filterReplies']] == ids[2:4])
+        rv, json = self.client.get(json['next'])
+        self.assertTrue([r['id'] for r in json['filterReplies']] == ids[4:])
+        self.assertTrue(json['next'] is None)
+
+        # the next pages keep ?fields=
+        rv, json = self.client.get('/filterReplies/?limit=2&fields=Answer')
+        pages = [json['filterReplies']]
+        while json['next']:
+            rv, json = self.client.get(json['next'])
+            pages.append(json['filterReplies'])
+        self.assertTrue(pages == [[{'id': id, 'Answer': i} for id, i in
+                                   zip(ids[start:start + 2],
+                                       range(start, start + 2))]
+                                  for start in (0, 2, 4)])
+
+        # the server caps the page size
+        self.app.config['MAX_PAGE_SIZE'] = 3
+        rv, json = self.client.get('/filterReplies/?limit=1000')
+        self.assertTrue(len(json['filterReplies']) == 3)
+        with self.assertRaises(ValidationError):
+            self.client.get('/filterReplies/?limit=0')
+
+        for id in ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_export(self):
+        rows = [{'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb', 'Type': 'AOI',
+                 'Answer': i, 'MaxAnswer': 12, 'CreatedDate': '22 Jan 2013',
+                 'ModifiedDate': '22 Jun 2013'} for i in range(5)]
+        rv, json = self.client.post('/filterReplies/', data=rows)
+        ids = json['ids']
+        self.app.config['EXPORT_CHUNK_SIZE'] = 2
+
+        rv, body = self.client.get('/filterReplies/export')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'application/x-ndjson')
+        lines = [json_module.loads(line) for line in body.splitlines()]
+        self.assertTrue([line['id'] for line in lines] == ids)
+        self.assertTrue(lines[3]['Answer'] == 3)
+
+        rv, body = self.client.get('/filterReplies/',
+                                   headers={'Accept': 'application/x-ndjson'})
+        self.assertTrue(rv.mimetype == 'application/x-ndjson')
+        self.assertTrue(len(body.splitlines()) == 5)
+
+        for id in ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_calc_syllabus(self):
+        rows = [{'UserId': 'user%d' % (i % 3), 'CourseSoftwareId': 'bbbbb',
+                 'Type': 'type%d' % (i % 4), 'Answer': str(i % 7),
+                 'MaxAnswer': '12', 'CreatedDate': '22 Jan 2013',
+                 'ModifiedDate': '22 Jun 2013'} for i in range(30)]
+        rv, json = self.client.post('/filterReplies/', data=rows)
+        ids = json['ids']
+
+        rv, json = self.client.get('/calc-syllabus/bbbbb/user1')
+        self.assertTrue(rv.status_code == 200)
+        rv, reference = self.client.get('/calc-syllabus/bbbbb/user1?engine=pandas')
+        self.assertTrue(sorted(json['syllabus']) == ['type0', 'type1', 'type2', 'type3'])
+        for Type, score in json['syllabus'].items():
+            self.assertAlmostEqual(score, reference['syllabus'][Type])
+        expected = [i % 7 / 12.0 for i in range(30) if i % 3 == 1 and i % 4 == 2]
+        self.assertAlmostEqual(json['syllabus']['type2'],
+                               sum(expected) / len(expected))
+
+        # both engines agree user by user
+        for UserId in ('user0', 'user1', 'user2', 'nobody'):
+            sql = sql_pivot('bbbbb', [UserId])
+            pandas = pandas_pivot('bbbbb', [UserId])
+            self.assertTrue(sql.keys() == pandas.keys())
+            for Type, score in sql.get(UserId, {}).items():
+                self.assertAlmostEqual(score, pandas[UserId][Type])
+
+        with self.assertRaises(ValidationError):
+            self.client.get('/calc-syllabus/bbbbb/user1?engine=spark')
+
+        for id in ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_calc_syllabus_cohort(self):
+        rows = [{'UserId': 'user%d' % (i % 3), 'CourseSoftwareId': 'bbbbb',
+                 'Type': 'type%d' % (i % 4), 'Answer': i % 7, 'MaxAnswer': 12,
+                 'CreatedDate': '22 Jan 2013', 'ModifiedDate': '22 Jun 2013'}
+                for i in range(30)]
+        # user3 only answered type0, the other types get the cohort means
+        rows.append(dict(rows[0], UserId='user3', Answer=6))
+        rv, json = self.client.post('/filterReplies/', data=rows)
+        ids = json['ids']
+
+        rv, json = self.client.get('/calc-syllabus/bbbbb')
+        self.assertTrue(rv.status_code == 200)
+        syllabus = json['syllabus']
+        self.assertTrue(sorted(syllabus) == ['user0', 'user1', 'user2', 'user3'])
+        self.assertAlmostEqual(syllabus['user3']['type0'], .5)
+        for Type in ('type1', 'type2', 'type3'):
+            mean = sum(syllabus['user%d' % i][Type] for i in range(3)) / 3
+            self.assertAlmostEqual(syllabus['user3'][Type], mean)
+
+        rv, reference = self.client.get('/calc-syllabus/bbbbb?engine=pandas')
+        for UserId, scores in syllabus.items():
+            for Type, score in scores.items():
+                self.assertAlmostEqual(score, reference['syllabus'][UserId][Type])
+
+        rv, json = self.client.get('/calc-syllabus/bbbbb?UserIds=user3,user1,nobody')
+        self.assertTrue(sorted(json['syllabus']) == ['user1', 'user3'])
+        self.assertTrue(json['syllabus']['user3'] == syllabus['user3'])
+
+        for id in ids:
+            self.client.delete('/filterReplies/' + str(id))
+
+    def test_syllabus_scores(self):
+        posted_data = {'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb',
+                       'Type': 'AOI', 'Answer': 6, 'MaxAnswer': 12,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '22 Jun 2013'}
+        rv, json = self.client.post('/filterReplies/', data=posted_data)
+        location = '/filterReplies/' + str(rv.headers['Location'])
+        rv, json = self.client.post('/filterReplies/', data=[
+            dict(posted_data, Answer=3), dict(posted_data, Type='ROI')])
+        ids = json['ids']
+        self.assertTrue(materialized_pivot('bbbbb') ==
+                        {'aaaa': {'AOI': .375, 'ROI': .5}})
+
+        # moving a reply to another Type and user updates both aggregates
+        self.client.patch(location, data={'Type': 'ROI', 'Answer': 12})
+        self.assertTrue(materialized_pivot('bbbbb') ==
+                        {'aaaa': {'AOI': .25, 'ROI': .75}})
+        self.client.patch(location, data={'UserId': 'cccc'})
+        self.assertTrue(materialized_pivot('bbbbb', ['cccc']) ==
+                        {'cccc': {'ROI': 1.0}})
+        self.assertTrue(materialized_pivot('bbbbb') == sql_pivot('bbbbb'))
+
+        self.client.delete('/filterReplies/' + str(ids[0]))
+        self.assertTrue(materialized_pivot('bbbbb', ['aaaa']) ==
+                        {'aaaa': {'ROI': .5}})
+        self.assertTrue(rebuild_scores() == 0)
+
+        self.client.delete(location)
+        self.client.delete('/filterReplies/' + str(ids[1]))
+        self.assertTrue(materialized_pivot('bbbbb') == {})
+
+    def test_non_numeric_answers(self):
+        posted_data = {'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb',
+                       'Type': 'AOI', 'Answer': 6, 'MaxAnswer': 12,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '22 Jun 2013'}
+        for answer in ('n/a', 'inf', '1_000', True):
+            with self.assertRaises(ValidationError):
+                self.client.post('/filterReplies/', data=dict(posted_data, Answer=answer))
+        rv, json = self.client.post('/filterReplies/', data=[
+            posted_data, dict(posted_data, Answer='n/a')])
+        self.assertTrue(len(json['ids']) == 1 and json['errors'][0]['index'] == 1)
+        ids = json['ids']
+        with self.assertRaises(ValidationError):
+            self.client.patch('/filterReplies/%d' % ids[0], data={'MaxAnswer': 'x'})
+
+        # rows written around the API: all engines skip what is not a number
+        table = FilterReply.__table__
+        for Answer, MaxAnswer, UserId in (('n/a', '12', 'aaaa'), ('3', '0', 'aaaa'),
+                                          (' 3 ', '12', 'aaaa'), ('1-2', '4', 'cccc'),
+                                          ('x', '12', 'dddd'), ('6', '12', 'dddd')):
+            row = dict(posted_data, Answer=Answer, MaxAnswer=MaxAnswer,
+                       UserId=UserId, CreatedDate=datetime(2013, 1, 22),
+                       ModifiedDate=datetime(2013, 6, 22))
+            ids.append(routes_db.session.execute(table.insert(), row).lastrowid)
+            update_scores([row])
+        routes_db.session.commit()
+        expected = {'aaaa': {'AOI': .375}, 'cccc': {'AOI': .25},
+                    'dddd': {'AOI': .5}}
+        for engine in (materialized_pivot, sql_pivot, pandas_pivot):
+            pivot = engine('bbbbb')
+            self.assertTrue(sorted(pivot) == sorted(expected))
+            for UserId, scores in expected.items():
+                self.assertAlmostEqual(pivot[UserId]['AOI'], scores['AOI'])
+        self.assertTrue(rebuild_scores() == 0)
+        routes_db.session.commit()
+
+        for id in ids:
+            self.client.delete('/filterReplies/%d' % id)
+
+    def test_module_stats(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .5,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.post('/modules/', data=module_data)
+        location = rv.headers['Location']
+        rv, json = self.client.post('/modules/', data=[
+            dict(module_data, UserId='ccccc', N2K=.75, DAK=None, Included=0),
+            dict(module_data, UserId='eeeee', CourseMaterialId='ddddd', N2K=1.0,
+                 FilteredOut=1)])
+        ids = json['ids']
+
+        rv, json = self.client.get('/modules/stats/ExcelYYY')
+        self.assertTrue(json['count'] == 3)
+        self.assertTrue(json['N2K']['count'] == 3)
+        self.assertAlmostEqual(json['N2K']['mean'], 2 / 3.)
+        self.assertAlmostEqual(json['N2K']['stddev'], (7 / 72.) ** .5)
+        self.assertTrue(json['N2K']['min'] == .25 and json['N2K']['max'] == 1.0)
+        self.assertTrue(json['DAK']['count'] == 2)
+        self.assertAlmostEqual(json['IncludedRate'], 2 / 3.)
+        self.assertAlmostEqual(json['FilteredOutRate'], 1 / 3.)
+        self.assertTrue(sorted(json['materials']) == ['bbbbb', 'ddddd'])
+        self.assertTrue(json['materials']['bbbbb']['count'] == 2)
+        rv, json = self.client.get('/modules/stats/ExcelYYY/ddddd')
+        self.assertTrue(json['N2K']['mean'] == 1.0 and json['count'] == 1)
+
+        # a changed or deleted extreme is recomputed from the modules
+        self.client.patch(location, data={'N2K': .5})
+        rv, json = self.client.get('/modules/stats/ExcelYYY/bbbbb')
+        self.assertTrue(json['N2K']['min'] == .5 and json['N2K']['max'] == .75)
+        self.client.delete('/modules/' + str(ids[0]))
+        rv, json = self.client.get('/modules/stats/ExcelYYY/bbbbb')
+        self.assertTrue(json['N2K']['max'] == .5 and json['count'] == 1)
+        self.assertTrue(json['IncludedRate'] == 1.0)
+
+        # moving a module to another material
+        self.client.patch(location, data={'CourseMaterialId': 'ddddd'})
+        with self.assertRaises(NotFound):
+            self.client.get('/modules/stats/ExcelYYY/bbbbb')
+        rv, json = self.client.get('/modules/stats/ExcelYYY')
+        self.assertTrue(list(json['materials']) == ['ddddd'])
+        self.assertTrue(json['materials']['ddddd']['count'] == 2)
+        self.assertTrue(rebuild_stats() == 0)
+        routes_db.session.commit()
+
+        self.client.delete(location)
+        self.client.delete('/modules/' + str(ids[1]))
+        with self.assertRaises(NotFound):
+            self.client.get('/modules/stats/ExcelYYY')
+        self.assertTrue(rebuild_stats() == 0)
+        routes_db.session.commit()
+
+    def test_multi_get(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .5,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.post('/modules/', data=[
+            dict(module_data, UserId='u%d' % i) for i in range(3)])
+        ids = json['ids']
+        missing = ids[-1] + 100
+
+        # request order, duplicates once, missing ids reported
+        rv, json = self.client.get('/modules/?ids=%d,%d,%d,%d' % (
+            ids[2], missing, ids[0], ids[2]))
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([row['id'] for row in json['modules']] == [ids[2], ids[0]])
+        self.assertTrue(json['modules'][0]['UserId'] == 'u2')
+        self.assertTrue(json['missing'] == [missing])
+        rv, json = self.client.get('/modules/?ids=%d&fields=N2K' % ids[1])
+        self.assertTrue(json['modules'] == [{'id': ids[1], 'N2K': .25}])
+        with self.assertRaises(ValidationError):
+            self.client.get('/modules/?ids=1,x')
+        self.app.config['MAX_MULTI_GET'] = 2
+        with self.assertRaises(ValidationError):
+            self.client.get('/modules/?ids=1,2,3')
+
+        # the lookup routes list the rows inline on request
+        url = '/module-id/ExcelYYY/bbbbb/u1'
+        rv, json = self.client.get(url)
+        self.assertTrue(json == {'ids': [ids[1]]})
+        rv, json = self.client.get(url + '?fields=all')
+        self.assertTrue(json['modules'][0]['UserId'] == 'u1')
+        self.assertTrue(json['modules'][0]['CreatedDate'] == '2013-01-22T00:00:00Z')
+        rv, json = self.client.get(url + '?fields=DAK')
+        self.assertTrue(json['modules'] == [{'id': ids[1], 'DAK': .5}])
+
+        for id in ids:
+            self.client.delete('/modules/%d' % id)
+
+    def test_upsert(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .5,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.send('/modules/', 'PUT', module_data)
+        self.assertTrue(rv.status_code == 201)
+        location = rv.headers['Location']
+        rv, json = self.client.send('/modules/', 'PUT', dict(
+            module_data, N2K=.75, CreatedDate='1 Jan 2014', ModifiedDate='2 Jan 2014'))
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['Location'] == location)
+        rv, json = self.client.get(location)
+        self.assertTrue(json['N2K'] == .75)
+        self.assertTrue(json['CreatedDate'] == '2013-01-22T00:00:00Z')
+        self.assertTrue(json['ModifiedDate'] == '2014-01-02T00:00:00Z')
+
+        # a batch inserts and updates, the last row of a key wins
+        rv, json = self.client.send('/modules/', 'PUT', [
+            dict(module_data, N2K=.5), dict(module_data, UserId='ccccc'),
+            dict(module_data, UserId=None), dict(module_data, N2K=1.0)])
+        self.assertTrue(rv.status_code == 200)
+        ids = json['ids']
+        self.assertTrue(ids[0] == ids[2] == int(location.split('/')[2]))
+        self.assertTrue(json['created'] == 1)
+        self.assertTrue(json['errors'][0]['index'] == 2)
+        rv, json = self.client.get(location)
+        self.assertTrue(json['N2K'] == 1.0)
+        rv, json = self.client.get('/modules/stats/ExcelYYY/bbbbb')
+        self.assertTrue(json['count'] == 2 and json['N2K']['max'] == 1.0)
+        self.assertTrue(json['N2K']['min'] == .25)
+        self.assertTrue(rebuild_stats() == 0)
+        routes_db.session.commit()
+
+        # POST and PATCH cannot duplicate a key
+        with self.assertRaises(ValidationError):
+            self.client.post('/modules/', data=module_data)
+        with self.assertRaises(ValidationError):
+            self.client.patch('/modules/%d' % ids[1], data={'UserId': 'aaaaa'})
+        with self.assertRaises(ValidationError):
+            self.client.send('/modules/', 'PUT', dict(module_data, UserId=None))
+        for id in ids[:2]:
+            self.client.delete('/modules/%d' % id)
+
+    def test_merge_duplicates(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        engine = create_engine('sqlite:///' + path)
+        try:
+            Module.__table__.create(engine)
+            engine.execute('DROP INDEX uq_modules_course_material_user')
+            module = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                      'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .5,
+                      'Included': 1, 'FilteredOut': 0,
+                      'CreatedDate': datetime(2013, 1, 22)}
+            engine.execute(Module.__table__.insert(), [
+                dict(module, ModifiedDate=datetime(2013, 6, 23)),
+                dict(module, ModifiedDate=datetime(2013, 6, 24), N2K=.75),
+                dict(module, ModifiedDate=datetime(2013, 6, 22)),
+                dict(module, ModifiedDate=datetime(2013, 6, 22), UserId='ccccc')])
+            self.assertTrue('uq_modules_course_material_user' in upgrade(engine))
+            rows = engine.execute('SELECT id, N2K FROM modules ORDER BY id').fetchall()
+            self.assertTrue([tuple(row) for row in rows] == [(2, .75), (4, .25)])
+            rows = engine.execute('SELECT RowId FROM tombstones ORDER BY RowId')
+            self.assertTrue([row[0] for row in rows] == [1, 3])
+            rows = engine.execute('SELECT Rows, N2KMax FROM moduleStats')
+            self.assertTrue([tuple(row) for row in rows] == [(2, .75)])
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+    def test_change_feed(self):
+        # the tables outlive the tests, forget the deletions of the others
+        routes_db.session.query(Tombstone).delete()
+        routes_db.session.commit()
+        now = datetime.utcnow()
+        start = (now - timedelta(hours=3)).isoformat()
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .5,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013'}
+        rv, json = self.client.post('/modules/', data=[
+            dict(module_data, UserId='u%d' % i, ModifiedDate=(
+                now - timedelta(hours=2, minutes=i)).isoformat())
+            for i in range(5)] + [
+            dict(module_data, ModifiedDate=(now - timedelta(days=60)).isoformat())])
+        ids = json['ids']
+
+        # pages of 2 in (ModifiedDate, id) order, the old row is not in it
+        rv, json = self.client.get('/modules/?modified_since=%s&limit=2&fields=UserId' % start)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['modules'] == [{'id': ids[4], 'UserId': 'u4'},
+                                            {'id': ids[3], 'UserId': 'u3'}])
+        self.assertTrue(json['deleted'] == [])
+        seen = [row['id'] for row in json['modules']]
+        while json['next']:
+            self.assertTrue('fields=UserId' in json['next'])
+            rv, json = self.client.get(json['next'])
+            seen += [row['id'] for row in json['modules']]
+        self.assertTrue(seen == ids[4::-1])
+
+        # nothing new since the cursor, then a change and a deletion
+        cursor = json['cursor']
+        rv, json = self.client.get('/modules/?cursor=' + cursor)
+        self.assertTrue(json['modules'] == [] and json['deleted'] == [])
+        self.assertTrue(json['cursor'] == cursor and json['next'] is None)
+        self.client.patch('/modules/%d' % ids[2], data={'N2K': .75})
+        self.client.delete('/modules/%d' % ids[0])
+        rv, json = self.client.get('/modules/?cursor=' + cursor)
+        self.assertTrue([row['id'] for row in json['modules']] == [ids[2]])
+        self.assertTrue(json['modules'][0]['N2K'] == .75)
+        self.assertTrue(json['deleted'] == [ids[0]])
+        rv, json = self.client.get('/modules/?cursor=' + json['cursor'])
+        self.assertTrue(json['modules'] == [] and json['deleted'] == [])
+
+        # the filter replies have their own feed
+        rv, json = self.client.get('/filterReplies/?modified_since=' + start)
+        self.assertTrue(json['filterReplies'] == [] and json['deleted'] == [])
+
+        # positions older than the tombstones are kept are refused
+        with self.assertRaises(ValidationError):
+            self.client.get('/modules/?modified_since=2013-06-01')
+        with self.assertRaises(ValidationError):
+            self.client.get('/modules/?cursor=nonsense')
+
+        for id in ids[1:]:
+            self.client.delete('/modules/%d' % id)
+
+    def test_token_cache(self):
+        rv, json = self.client.get('/modules/')
+        self.assertTrue(rv.status_code == 200)
+        cache = self.app.extensions['auth_token_cache']
+        cached = cache.get(self.token)
+        self.assertTrue(cached.username == self.default_username)
+
+        # cached tokens are still verified against the user
+        rv, json = self.client.get('/modules/')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(User.verify_auth_token(self.token).id == cached.id)
+        self.assertTrue(User.verify_auth_token('bogus') is None)
+
+        # changing the user drops its tokens from the cache
+        user = User.query.get(cached.id)
+        user.username = 'johnny'
+        User.query.session.commit()
+        self.assertTrue(cache.get(self.token) is None)
+        self.assertTrue(User.verify_auth_token(self.token).username == 'johnny')
+
+    def test_token_cache_other_worker(self):
+        rv, json = self.client.get('/modules/')
+        cached = self.app.extensions['auth_token_cache'].get(self.token)
+        self.assertTrue(cached.username == self.default_username)
+
+        # another worker renames the user, its cache discard does not reach
+        # this process but the version it bumps does
+        routes_db.session.execute(
+            'UPDATE users SET username = :name WHERE id = :id',
+            {'name': 'johnny', 'id': cached.id})
+        routes_db.session.execute(bump_user_version)
+        routes_db.session.commit()
+        self.assertTrue(User.verify_auth_token(self.token).username == 'johnny')
+        rv, json = self.client.get('/modules/')
+        self.assertTrue(rv.status_code == 200)
+
+    def test_conditional_get(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.post('/modules/', data=module_data)
+        location = rv.headers['Location']
+
+        rv, json = self.client.get(location)
+        self.assertTrue(rv.status_code == 200)
+        etag = rv.headers['ETag']
+        rv, json = self.client.get(location, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 304)
+        self.assertTrue(rv.data == b'')
+        rv, json = self.client.get(location, headers={
+            'If-Modified-Since': 'Sun, 23 Jun 2013 00:00:00 GMT'})
+        self.assertTrue(rv.status_code == 304)
+
+        rv, json = self.client.get('/modules/')
+        page_etag = rv.headers['ETag']
+        rv, json = self.client.get('/modules/', headers={'If-None-Match': page_etag})
+        self.assertTrue(rv.status_code == 304)
+        # pages are validated by ETag only
+        self.assertTrue('Last-Modified' not in rv.headers)
+        rv, json = self.client.get('/modules/', headers={
+            'If-Modified-Since': 'Sun, 23 Jun 2030 00:00:00 GMT'})
+        self.assertTrue(rv.status_code == 200)
+
+        # a modification changes both validators
+        self.client.patch(location, data={'UserId': 'zzzz'})
+        rv, json = self.client.get(location, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['UserId'] == 'zzzz')
+        rv, json = self.client.get('/modules/', headers={'If-None-Match': page_etag})
+        self.assertTrue(rv.status_code == 200)
+
+        self.client.delete(location)
+        with self.assertRaises(NotFound):
+            self.client.get(location, headers={'If-None-Match': etag})
+
+    def test_patch(self):
+        posted_data = {'UserId': 'aaaa', 'CourseSoftwareId': 'bbbbb',
+                       'Type': 'AOI', 'Answer': 6, 'MaxAnswer': 12,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '22 Jun 2013'}
+        rv, json = self.client.post('/filterReplies/', data=posted_data)
+        location = '/filterReplies/' + str(rv.headers['Location'])
+
+        rv, json = self.client.patch(location, data={
+            'Answer': 3, 'CreatedDate': '2013-01-23T10:00:00+02:00', 'id': 999})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json == {})
+        rv, json = self.client.get(location)
+        self.assertTrue(json['Answer'] == 3)
+        self.assertTrue(json['Type'] == 'AOI')
+        self.assertTrue(json['CreatedDate'] == '2013-01-23T10:00:00Z')
+        self.assertTrue(json['ModifiedDate'] > '2013-06-22')
+        self.assertTrue(materialized_pivot('bbbbb', ['aaaa']) ==
+                        {'aaaa': {'AOI': .25}})
+
+        with self.assertRaises(ValidationError):
+            self.client.patch(location, data={'CreatedDate': 'not a date'})
+        with self.assertRaises(NotFound):
+            self.client.patch('/filterReplies/999999', data={'Answer': 1})
+        with self.assertRaises(NotFound):
+            self.client.patch('/modules/999999', data={'N2K': .1})
+        self.client.delete(location)
+
+    def test_serializers(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                       'Included': 1, 'FilteredOut': 0}
+        dates = [('22 Jan 2013', '2013-06-23T10:11:12.5Z'),
+                 ('2013-01-22T10:00:00+02:00', '2013-06-23 10:11:12')]
+        ids = []
+        for created, modified in dates:
+            data = dict(module_data, CreatedDate=created, ModifiedDate=modified,
+                        UserId='u%d' % len(ids))
+            decoded = decoder(Module)(data)
+            module = Module().import_data(data)
+            for key, value in decoded.items():
+                self.assertTrue(getattr(module, key) == value)
+            rv, json = self.client.post('/modules/', data=data)
+            ids.append(int(rv.headers['Location'].split('/')[2]))
+
+        encode = encoder(Module)
+        rows = Module.query.session.query(*columns(Module)) \
+            .filter(Module.id.in_(ids)).order_by(Module.id)
+        for row, id in zip(rows, ids):
+            self.assertTrue(encode(row) == Module.query.get(id).export_data())
+        self.assertTrue(encode(row)['ModifiedDate'] == '2013-06-23T10:11:12Z')
+
+        with self.assertRaises(ValidationError):
+            decoder(Module)({'UserId': 'aaaaa'})
+        # dates that are not strings, or not dates, are invalid rows
+        for created in (20130122, None, ['2013-01-22'], 'not a date'):
+            data = dict(module_data, CreatedDate=created,
+                        ModifiedDate='2013-06-23')
+            with self.assertRaises(ValidationError):
+                decoder(Module)(data)
+            with self.assertRaises(ValidationError):
+                Module().import_data(data)
+            with self.assertRaises(ValidationError):
+                self.client.post('/modules/', data=data)
+            with self.assertRaises(ValidationError):
+                self.client.patch('/modules/%d' % ids[0],
+                                  data={'CreatedDate': created})
+        for id in ids:
+            self.client.delete('/modules/' + str(id))
+
+    def test_fields(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.post('/modules/', data=module_data)
+        location = rv.headers['Location']
+        id = int(location.split('/')[2])
+
+        rv, json = self.client.get(location + '?fields=UserId,N2K')
+        self.assertTrue(json == {'id': id, 'UserId': 'aaaaa', 'N2K': .25})
+        rv, json = self.client.get('/modules/?fields=N2K,ModifiedDate')
+        self.assertTrue(json['modules'] == [
+            {'id': id, 'N2K': .25, 'ModifiedDate': '2013-06-23T00:00:00Z'}])
+        rv, json = self.client.get('/filterReplies/?fields=UserId')
+        self.assertTrue(json['filterReplies'] == [])
+
+        with self.assertRaises(ValidationError):
+            self.client.get(location + '?fields=UserId,Password')
+        self.client.delete(location)
+
+    def test_metrics(self):
+        module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                       'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                       'Included': 1, 'FilteredOut': 0,
+                       'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+        rv, json = self.client.post('/modules/', data=module_data)
+        location = rv.headers['Location']
+        rv, json = self.client.get(location)
+        self.client.get(location, headers={'If-None-Match': rv.headers['ETag']})
+        self.client.get(location)
+        rv, export = self.client.get('/modules/export')
+
+        rv, text = self.client.get('/metrics')
+        self.assertTrue(rv.status_code == 200)
+        lines = dict(line.rsplit(' ', 1) for line in text.splitlines()
+                     if not line.startswith('#'))
+        labels = '{endpoint="api.get_module",method="GET"'
+        self.assertTrue(lines['http_requests_total' + labels +
+                              ',status="200"}'] == '2')
+        self.assertTrue(lines['http_requests_total' + labels +
+                              ',status="304"}'] == '1')
+        self.assertTrue(lines['http_request_duration_seconds_count' + labels +
+                              '}'] == '3')
+        self.assertTrue(lines['http_request_duration_seconds_bucket' + labels +
+                              ',le="+Inf"}'] == '3')
+        self.assertTrue(float(lines['db_statements_per_request_sum' + labels +
+                                    '}']) >= 3)
+        self.assertTrue(float(lines['http_response_size_bytes_sum' + labels +
+                                    '}']) > 0)
+        # streamed responses are counted as they are sent
+        self.assertTrue(float(lines['http_response_size_bytes_sum'
+                                    '{endpoint="api.export_modules",'
+                                    'method="GET"}']) == len(export.encode()))
+
+        # other clients than METRICS_ALLOW need a token
+        self.app.config['METRICS_ALLOW'] = []
+        rv, text = TestClient(self.app, 'bogus', '').get('/metrics')
+        self.assertTrue(rv.status_code == 401)
+        rv, text = self.client.get('/metrics')
+        self.assertTrue(rv.status_code == 200)
+        self.client.delete(location)
+
+    def test_storage_profile(self):
+        # WAL is a property of the database file, keep it off the test one
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        # the routes' session may still be bound to the engine of an earlier
+        # test's app, which has no pragmas
+        routes_db.session.remove()
+        self.app.config.update(SQLITE_PROFILE='production',
+                               SQLALCHEMY_DATABASE_URI='sqlite:///' + path)
+        try:
+            init_storage(self.app)
+            upgrade()
+            user = User(username=self.default_username)
+            user.set_password(self.default_password)
+            routes_db.session.add(user)
+            routes_db.session.commit()
+            client = TestClient(self.app, user.generate_auth_token(), '')
+            module_data = {'UserId': 'aaaaa', 'CourseMaterialId': 'bbbbb',
+                           'CourseSoftwareId': 'ExcelYYY', 'N2K': .25, 'DAK': .32,
+                           'Included': 1, 'FilteredOut': 0,
+                           'CreatedDate': '22 Jan 2013', 'ModifiedDate': '23 Jun 2013'}
+            rv, json = client.post('/modules/', data=module_data)
+            location = rv.headers['Location']
+            rv, json = client.get(location)
+            self.assertTrue(json['UserId'] == 'aaaaa')
+
+            # the GET routes read through the read-only pool of the WAL database
+            session = read_session()
+            self.assertTrue(session.execute('PRAGMA journal_mode').scalar() == 'wal')
+            self.assertTrue(session.execute('PRAGMA query_only').scalar() == 1)
+            with self.assertRaises(OperationalError):
+                session.execute('DELETE FROM modules')
+            session.remove()
+            session.bind.dispose()
+        finally:
+            routes_db.session.remove()
+            routes_db.get_engine(self.app).dispose()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_secret_key_required(self):
+        secret_key = os.environ.pop('SECRET_KEY', None)
+        try:
+            with self.assertRaises(RuntimeError):
+                create_app('production')
+        finally:
+            if secret_key is not None:
+                os.environ['SECRET_KEY'] = secret_key
+
+    def test_server(self):
+        self.assertTrue(parse_address('127.0.0.1:5000') == ('127.0.0.1', 5000))
+        self.assertTrue(parse_address('[::1]:5000') == ('::1', 5000))
+        with self.assertRaises(ValueError):
+            parse_address('localhost')
+        listener = listen('127.0.0.1:0')
+        port = listener.getsockname()[1]
+        self.assertTrue(port != 0 and listener.gettimeout() == 0.0)
+        listener.close()
+
+        # a master with one worker, recycled every two requests
+        self.app.config.update(WORKERS=1, THREADS=2, MAX_REQUESTS=2,
+                               LISTEN='127.0.0.1:%d' % port)
+        db.session.remove()
+        routes_db.session.remove()
+        master = os.fork()
+        if master == 0:
+            try:
+                serve(self.app)
+            finally:
+                os._exit(0)
+
+        def workers():
+            with open('/proc/%d/task/%d/children' % (master, master)) as f:
+                return [int(pid) for pid in f.read().split()]
+
+        def wait_for(condition):
+            deadline = time.time() + 10
+            while not condition():
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.05)
+
+        def get(url):
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', url, headers={
+                'Host': 'example.com', 'Authorization': self.client.auth})
+            rv = connection.getresponse()
+            body = rv.read().decode('utf-8')
+            connection.close()
+            return rv.status, body
+
+        try:
+            wait_for(lambda: len(workers()) == 1)
+            first = workers()
+            self.assertTrue(get('/modules/')[0] == 200)
+            self.assertTrue(get('/modules/')[0] == 200)
+            wait_for(lambda: workers() and workers() != first)
+
+            # a crashed worker is replaced
+            second = workers()
+            self.assertTrue(get('/modules/')[0] == 200)
+            os.kill(second[0], signal.SIGKILL)
+            wait_for(lambda: workers() and workers() != second)
+            status, text = get('/modules/')
+            self.assertTrue(status == 200)
+
+            # the counts of the recycled worker are kept
+            status, text = get('/metrics')
+            lines = dict(line.rsplit(' ', 1) for line in text.splitlines()
+                         if not line.startswith('#'))
+            self.assertTrue(int(lines[
+                'http_requests_total{endpoint="api.get_modules",'
+                'method="GET",status="200"}']) >= 3)
+        finally:
+            os.kill(master, signal.SIGTERM)
+            pid, status = os.waitpid(master, 0)
+        self.assertTrue(os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+
+    def test_startup_budget(self):
+        # in a fresh interpreter, as the workers of the pre-fork server start
+        output = subprocess.check_output(
+            [sys.executable, '-W', 'ignore', '-m', 'app_v1.startup',
+             'testing', '--json'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        figures = json_module.loads(output.decode('utf-8'))
+        self.assertTrue('pandas' not in figures['modules'])
+        self.assertTrue('dateutil' not in figures['modules'])
+        self.assertTrue(figures['seconds'] <= figures['time_budget'])
+        self.assertTrue(figures['peak_memory'] <= figures['memory_budget'])
+        self.assertTrue([name for name, seconds in figures['steps']] ==
+                        ['models', 'config', 'extensions', 'auth', 'routes'])
+
 '''
 
     def test_orders_and_items(self):